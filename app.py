@@ -1,8 +1,14 @@
 import argparse
+import itertools
 import json
 import logging
+import math
 import os
+import random
+import re
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import partitioncache.apply_cache
 import partitioncache.cache_handler
@@ -11,21 +17,37 @@ import partitioncache.queue
 import sqlglot
 import sqlparse
 from dotenv import load_dotenv
-from flask import Flask, jsonify, redirect, render_template, request, url_for
+from flask import Flask, Response, jsonify, redirect, render_template, request, url_for
 from flask_cors import CORS
 from psycopg import sql
 
+from database.coordinate_blobs import decode_coordinate_blob
 from database.handlers import get_database_handler
+from database.init_db import detect_compact_schema
 
 USE_TMP_TABLE_FOR_PARTITIONCACHE_OVER_NUM_PARTITIONS = 100_000
 PUSH_TO_QUEUE = True
 TMP_JOIN_ALL = False  # TODO: Needs heuristic which is faster in which cases
+USE_FRAGMENT_CACHE = True  # Also look up (and queue) canonical sub-motifs of the search in the partition cache
+MAX_FRAGMENT_SIZE = 3  # Maximum number of atoms per cached sub-motif fragment
+MAX_CACHED_FRAGMENTS = 5  # Maximum number of sub-motif fragments (most selective first) looked up and queued per search
+USE_SELECTIVITY_JOIN_ORDER = True  # Join the atoms of the search query most selective first
+ATOM_STATISTICS_TTL = 3600  # Seconds until the cached (element, origin) frequencies are reloaded
+ATOM_STATISTICS_SAMPLE_RANGES = 10  # MySQL: number of random data_points id ranges sampled for the frequencies
+ATOM_STATISTICS_RANGE_SIZE = 100_000  # MySQL: number of ids per sampled range
+DEFAULT_DISTANCE_TOLERANCE = 0.1  # Allowed deviation (in Angstrom) of each searched distance
+MAX_DISTANCE_TOLERANCE = 5.0
+ESTIMATE_MATCH_COUNT = True  # Estimate the total number of matches in parallel, returned if the result limit is reached
+ESTIMATE_SAMPLE_SIZE = 200  # Number of complexes searched completely for the estimate
+ESTIMATE_TIMEOUT = 5  # Seconds to wait for the estimate after the search finished
+ESTIMATE_MAX_PENDING = 4  # Maximum number of concurrent estimates, further searches are returned without estimate
 
 # Add argument parser
 parser = argparse.ArgumentParser(description="Run the Flask application with partition cache settings")
 parser.add_argument("--cachetype", type=str, default="shelve", choices=["shelve", "redis", "rocksdb"], help="Type of partition cache to use (shelve or redis)")
 parser.add_argument("--database_env", type=str, default="database.env", help="Path to the database.env file")
 parser.add_argument("--dbtype", type=str, default="postgresql", choices=["postgresql", "mysql"], help="Type of database to use (postgresql or mysql)")
+parser.add_argument("--partitioned_data_points", action="store_true", help="data_points is partitioned by complex_data_id (see importer.py --partitioning)")
 args = parser.parse_args()
 
 
@@ -58,6 +80,28 @@ elif args.dbtype == "mysql":
 else:
     raise ValueError(f"Invalid database type: {args.dbtype}")
 
+# Optional read replicas (comma separated host[:port]) for searches and molecule loading, imports always use the primary
+replica_params = []
+for replica in os.getenv("PG_DB_REPLICAS" if args.dbtype == "postgresql" else "MY_DB_REPLICAS", "").split(","):
+    if replica.strip():
+        host, _, port = replica.strip().partition(":")
+        replica_params.append({**db_params, "host": host, "port": port or db_params["port"]})
+
+# Cached (element, origin) frequencies used to estimate the selectivity of motif atoms
+_atom_statistics: dict[tuple[int, str], int] | None = None
+_atom_statistics_time = 0.0
+_atom_statistics_lock = threading.Lock()  # Held while the statistics are refreshed in the background
+
+# Cached codes of the residue names (origin) for the compact schema
+_origin_codes: dict[str, int] = {}
+
+# Whether the database uses the compact schema, detected on first use
+_compact_schema: bool | None = None
+
+# Runs the match count estimates in parallel to the searches, a slot is taken per pending estimate
+_estimate_executor = ThreadPoolExecutor(max_workers=ESTIMATE_MAX_PENDING)
+_estimate_slots = threading.BoundedSemaphore(ESTIMATE_MAX_PENDING)
+
 
 @app.route("/")
 def index():
@@ -70,7 +114,7 @@ def get_pdb_identifiers():
     if len(search_term) > 50:
         return jsonify({"error": "Search term too long"}), 400
     try:
-        with get_database_handler(args.dbtype, db_params) as handler:
+        with get_database_handler(args.dbtype, db_params, replicas=replica_params) as handler:
             if search_term:
                 _, pdb_data = handler.execute_query(
                     sql.SQL("""
@@ -106,21 +150,42 @@ def get_pdb_identifiers():
         return jsonify({"error": "Failed to retrieve PDB identifiers"}), 500
 
 
+def get_coordinate_blob(handler, pdb_id) -> bytes | None:
+    """Load the coordinate blob of the complex with a single row read, None if it has none"""
+    _, blobs = handler.execute_query(
+        sql.SQL("""
+        SELECT cc.data
+        FROM complex_coordinates cc
+        JOIN complex_data cd ON cd.complex_data_id = cc.complex_data_id
+        WHERE cd.pdb_id = {}
+        """)
+        .format(sql.Literal(pdb_id))
+        .as_string()
+    )
+    return bytes(blobs[0][0]) if blobs else None
+
+
 @app.route("/get_molecule/<pdb_id>")
 def get_molecule(pdb_id):
     try:
-        with get_database_handler(args.dbtype, db_params) as handler:
-            _, atoms = handler.execute_query(
-                sql.SQL("""
-                SELECT id, element, type, origin, x, y, z
-                FROM data_points
-                WHERE data_points.complex_data_id = (
-                    SELECT complex_data_id FROM complex_data WHERE pdb_id = {}
+        with get_database_handler(args.dbtype, db_params, replicas=replica_params) as handler:
+            blob = get_coordinate_blob(handler, pdb_id)
+            if blob is not None:
+                columns = decode_coordinate_blob(blob)
+                atoms = list(zip(*(columns[c] for c in ["id", "element", "type", "origin", "x", "y", "z"])))
+            else:
+                # Fall back to data_points for complexes imported without coordinate blob
+                _, atoms = handler.execute_query(
+                    sql.SQL("""
+                    SELECT id, element, type, origin, x, y, z
+                    FROM data_points
+                    WHERE data_points.complex_data_id = (
+                        SELECT complex_data_id FROM complex_data WHERE pdb_id = {}
+                    )
+                    """)
+                    .format(sql.Literal(pdb_id))
+                    .as_string()
                 )
-                """)
-                .format(sql.Literal(pdb_id))
-                .as_string()
-            )
             if not atoms:
                 app.logger.warning(f"No atoms found for PDB ID: {pdb_id}")
                 return jsonify({"error": "No atoms found"}), 404
@@ -145,51 +210,80 @@ def get_molecule(pdb_id):
         return jsonify({"error": f"Error retrieving molecule: {str(e)}"}), 500
 
 
-def get_extended_search_query(selected_pairs) -> str:
-    query = generate_search_query(selected_pairs, use_partition_cache=True).as_string()
+@app.route("/get_molecule_blob/<pdb_id>")
+def get_molecule_blob(pdb_id):
+    """Serve the compressed coordinate blob of the complex as is, it is decoded by the viewer's worker"""
+    try:
+        with get_database_handler(args.dbtype, db_params, replicas=replica_params) as handler:
+            blob = get_coordinate_blob(handler, pdb_id)
+        if blob is None:
+            return jsonify({"error": "No coordinate blob found"}), 404
+        return Response(blob, mimetype="application/octet-stream")
+    except Exception as e:
+        app.logger.error(f"Error retrieving coordinate blob for PDB ID {pdb_id}: {str(e)}")
+        return jsonify({"error": f"Error retrieving coordinate blob: {str(e)}"}), 500
+
 
+def get_extended_search_query(selected_pairs, tolerance=DEFAULT_DISTANCE_TOLERANCE, search_mode="atom", partition_keys=None) -> str:
+    query = generate_search_query(
+        selected_pairs, use_partition_cache=True, tolerance=tolerance, search_mode=search_mode, partition_keys=partition_keys
+    ).as_string()
+    return _transpile_query(query)
+
+
+def _transpile_query(query: str) -> str:
     if args.dbtype == "mysql":
         # Parse and transpile the query from PostgreSQL to MySQL
         query_list = []
         for q in query.split(";"):
             qm = sqlglot.transpile(q, read="postgres", write="mysql")[0]
+            if USE_SELECTIVITY_JOIN_ORDER:
+                # MySQL reorders explicit JOINs, STRAIGHT_JOIN keeps the selectivity order of the atom joins
+                qm = re.sub(r"\b(?:INNER\s+)?JOIN\s+(\S+)\s+(?:AS\s+)?(`?p\d+`?)\s+ON\b", r"STRAIGHT_JOIN \1 AS \2 ON", qm)
             query_list.append(qm)
         query = ";".join(query_list)
 
     return query
 
 
-def generate_search_query(selected_pairs,  use_partition_cache=True) -> sql.Composed:
+def generate_search_query(
+    selected_pairs, use_partition_cache=True, tolerance=DEFAULT_DISTANCE_TOLERANCE, search_mode="atom", partition_keys=None
+) -> sql.Composed:
+    """Generate the search query, partition_keys is the result of get_search_partition_keys if already looked up"""
     if not use_partition_cache:
         # Build Extended query without partition cache
-        query = generate_search_query_sql(selected_pairs, base_query=False)
+        if search_mode == "residue":
+            query = generate_residue_search_query_sql(selected_pairs, tolerance=tolerance)
+        else:
+            query = generate_search_query_sql(selected_pairs, base_query=False, tolerance=tolerance)
         return query
 
     else:  # Using partition cache
-        
-        # Generate Base Query for searching in cache
-        base_query = generate_search_query_sql(selected_pairs, base_query=True)
-
-        if PUSH_TO_QUEUE:
-            partitioncache.queue.push_to_queue(base_query.as_string())
-
-        # Get Partition Keys for the base query from cache
-        cachetype = args.cachetype
-        partiton_key_set, num_total_build_hashes, num_used_hashes = partitioncache.apply_cache.get_partition_keys(
-            base_query.as_string(), partitioncache.cache_handler.get_cache_handler(cachetype), partition_key="complex_data_id"
-        )
+        if partition_keys is None:
+            partition_keys = get_search_partition_keys(selected_pairs, tolerance)
+        partiton_key_set, num_total_build_hashes, num_used_hashes = partition_keys
 
         # Build Extended Query for application (e.g. LIMIT clause, PartitionList, PDB_ID id via comple_data table)
 
-        query = generate_search_query_sql(selected_pairs, base_query=False, limit=0)
+        if search_mode == "residue":
+            # Match on the residue level first and refine to atoms of the candidate residues
+            query = generate_residue_search_query_sql(selected_pairs, limit=0, tolerance=tolerance)
+        else:
+            query = generate_search_query_sql(selected_pairs, base_query=False, limit=0, tolerance=tolerance)
 
         ## ADD PARTITION CACHE QUERY TO ORIGINAL QUERY (Simple IN clause for smaller numbe roor TMP TABLE)
         if partiton_key_set is not None:
             query_str = query.as_string()
 
             if len(partiton_key_set) < USE_TMP_TABLE_FOR_PARTITIONCACHE_OVER_NUM_PARTITIONS:
+                # With a partitioned data_points table, restrict all tables so unused partitions are pruned
+                if args.partitioned_data_points:
+                    alias = None
+                else:
+                    alias = "cd"
+
                 query_str = partitioncache.apply_cache.extend_query_with_partition_keys(
-                    query_str, partiton_key_set, partition_key="complex_data_id", method="IN", p0_alias="cd"
+                    query_str, partiton_key_set, partition_key="complex_data_id", method="IN", p0_alias=alias
                 )
 
             else:
@@ -199,7 +293,7 @@ def generate_search_query(selected_pairs,  use_partition_cache=True) -> sql.Comp
                 else:
                     analyze_tmp_table = False
                     
-                if TMP_JOIN_ALL:
+                if TMP_JOIN_ALL or args.partitioned_data_points:
                     alias = None
                 else:
                     alias = "cd"
@@ -226,7 +320,475 @@ def generate_search_query(selected_pairs,  use_partition_cache=True) -> sql.Comp
         return sql.SQL(query_str) + sql.SQL(" LIMIT 500")  # type: ignore
 
 
-def generate_search_query_sql(selected_pairs, base_query=False, limit=500) -> sql.Composed:
+def get_search_partition_keys(selected_pairs, tolerance=DEFAULT_DISTANCE_TOLERANCE) -> tuple[set | None, int, int]:
+    """Queue the base queries of the search and get their partition keys from the cache"""
+    # Generate Base Queries for searching in cache
+    cache_queries = get_cache_queries(selected_pairs, tolerance)
+
+    if PUSH_TO_QUEUE:
+        for cache_query in cache_queries:
+            partitioncache.queue.push_to_queue(cache_query)
+
+    # Get Partition Keys for the base query and its fragments from cache
+    return get_partition_keys_for_queries(cache_queries, args.cachetype)
+
+
+def get_cache_queries(selected_pairs, tolerance=DEFAULT_DISTANCE_TOLERANCE) -> list[str]:
+    """Get the base query of the search and of all its canonical sub-motifs for the partition cache"""
+    base_query = generate_search_query_sql(selected_pairs, base_query=True, tolerance=tolerance)
+
+    # Additionally generate base queries for all canonical sub-motifs, so partitions cached
+    # for smaller (earlier) searches can be reused when the motif is refined
+    cache_queries = [base_query.as_string()]
+    if USE_FRAGMENT_CACHE:
+        for fragment in rank_fragments(get_motif_fragments(selected_pairs))[:MAX_CACHED_FRAGMENTS]:
+            fragment_query = generate_search_query_sql(fragment, base_query=True, tolerance=tolerance).as_string()
+            if fragment_query not in cache_queries:
+                cache_queries.append(fragment_query)
+
+    return cache_queries
+
+
+def estimate_match_count(
+    selected_pairs, partition_key_set, tolerance=DEFAULT_DISTANCE_TOLERANCE, search_mode="atom", cancelled=None
+) -> dict | None:
+    """Estimate the total number of matches by searching a random sample of complexes completely.
+
+    The sample is drawn from the partition keys cached for the search if available, otherwise from all complexes.
+    Returns the estimate with a 95% confidence interval, or None if cancelled (threading.Event) before the search.
+    If no sampled complex matches, the number of matches has no estimate and upper bound (estimate and upper are None),
+    only the number of matching complexes is bounded (rule of three, matching_complexes_upper).
+    """
+    with get_database_handler(args.dbtype, db_params, replicas=replica_params) as handler:
+        if partition_key_set is not None:
+            population_size = len(partition_key_set)
+            sample = random.sample(list(partition_key_set), min(ESTIMATE_SAMPLE_SIZE, population_size))
+        else:
+            _, rows = handler.execute_query("SELECT COUNT(*) FROM complex_data")
+            population_size = int(rows[0][0])
+            random_function = "RANDOM()" if args.dbtype == "postgresql" else "RAND()"
+            _, rows = handler.execute_query(
+                f"SELECT complex_data_id FROM complex_data ORDER BY {random_function} LIMIT {ESTIMATE_SAMPLE_SIZE}"
+            )
+            sample = [row[0] for row in rows]
+
+        if not sample:
+            return {"estimate": 0, "lower": 0, "upper": 0, "confidence": 0.95, "sample_size": 0, "population_size": population_size}
+
+        if cancelled is not None and cancelled.is_set():
+            return None
+
+        if search_mode == "residue":
+            query = generate_residue_search_query_sql(selected_pairs, limit=0, tolerance=tolerance)
+        else:
+            query = generate_search_query_sql(selected_pairs, base_query=False, limit=0, tolerance=tolerance)
+        query_str = partitioncache.apply_cache.extend_query_with_partition_keys(
+            query.as_string(), set(sample), partition_key="complex_data_id", method="IN", p0_alias="cd"
+        )
+        _, rows = handler.execute_query(_transpile_query(f"SELECT pdb_id, COUNT(*) FROM ({query_str}) sample_matches GROUP BY pdb_id"))
+
+    # Matches per sampled complex, including the complexes without any match
+    counts = [int(row[1]) for row in rows] + [0] * (len(sample) - len(rows))
+    n = len(counts)
+
+    if not rows:
+        # A zero variance interval would look certain. The rule of three only bounds the number of matching
+        # complexes, each of which can contain any number of matches
+        return {
+            "estimate": None,
+            "lower": 0,
+            "upper": None,
+            "matching_complexes_upper": population_size if n >= population_size else math.ceil(3 * population_size / n),
+            "confidence": 0.95,
+            "sample_size": n,
+            "population_size": population_size,
+        }
+
+    mean = sum(counts) / n
+    variance = sum((c - mean) ** 2 for c in counts) / (n - 1) if n > 1 else 0.0
+    # Standard error of the total with finite population correction
+    stderr = population_size * math.sqrt(variance / n * (1 - n / population_size))
+    estimate = population_size * mean
+
+    return {
+        "estimate": round(estimate),
+        "lower": max(round(estimate - 1.96 * stderr), sum(counts)),
+        "upper": round(estimate + 1.96 * stderr),
+        "confidence": 0.95,
+        "sample_size": n,
+        "population_size": population_size,
+    }
+
+
+def get_partition_keys_for_queries(queries: list[str], cachetype: str) -> tuple[set | None, int, int]:
+    """Get the partition keys of all given queries from the cache and intersect them.
+
+    Every query must describe a superset of the searched motif, so the intersection of all
+    cached partition key sets is still a valid restriction for the full search.
+    Returns None as partition key set if none of the queries could be answered by the cache.
+    """
+    cache_handler = partitioncache.cache_handler.get_cache_handler(cachetype)
+
+    partition_key_set = None
+    num_total_build_hashes = 0
+    num_used_hashes = 0
+    for query in queries:
+        keys, num_total, num_used = partitioncache.apply_cache.get_partition_keys(query, cache_handler, partition_key="complex_data_id")
+        num_total_build_hashes += num_total
+        num_used_hashes += num_used
+        if keys is None:
+            continue
+        partition_key_set = set(keys) if partition_key_set is None else partition_key_set & set(keys)
+
+    return partition_key_set, num_total_build_hashes, num_used_hashes
+
+
+def get_motif_fragments(selected_pairs, max_size=MAX_FRAGMENT_SIZE) -> list[list[dict]]:
+    """Split the motif into all connected proper sub-motifs (fragments) with 2 to max_size atoms.
+
+    Each fragment contains all distance pairs between its atoms and is returned in the same
+    format as selected_pairs, with matchids relabelled canonically. Identical sub-motifs of
+    different searches therefore produce identical queries and share partition cache entries.
+    """
+    atoms = {}
+    distances = {}
+    for pair in selected_pairs:
+        for atom in [pair["atom1"], pair["atom2"]]:
+            atoms[atom["matchid"]] = atom
+        edge = tuple(sorted((pair["atom1"]["matchid"], pair["atom2"]["matchid"])))
+        distances[edge] = pair["distance"]
+
+    # The full motif itself is already looked up as base query of the search
+    fragments = {}
+    for size in range(2, min(max_size, len(atoms) - 1) + 1):
+        for subset in itertools.combinations(sorted(atoms), size):
+            edges = {edge: dist for edge, dist in distances.items() if edge[0] in subset and edge[1] in subset}
+            if not _is_connected(subset, edges):
+                continue
+            fragment = _canonicalize_fragment(subset, atoms, edges)
+            fragments.setdefault(repr(fragment), fragment)
+
+    return list(fragments.values())
+
+
+def rank_fragments(fragments) -> list[list[dict]]:
+    """Order fragments by estimated selectivity (product of their atom selectivities), most selective first.
+
+    Small fragments of common atoms match almost every complex and restrict the search the least,
+    without atom statistics larger fragments are preferred.
+    """
+
+    def selectivity(fragment):
+        atoms = {atom["matchid"]: atom for pair in fragment for atom in [pair["atom1"], pair["atom2"]]}
+        return math.prod(get_atom_selectivities(atoms).values()), -len(atoms)
+
+    return sorted(fragments, key=selectivity)
+
+
+def _is_connected(subset, edges) -> bool:
+    reached = {subset[0]}
+    frontier = [subset[0]]
+    while frontier:
+        current = frontier.pop()
+        for a, b in edges:
+            if current not in (a, b):
+                continue
+            neighbour = b if a == current else a
+            if neighbour not in reached:
+                reached.add(neighbour)
+                frontier.append(neighbour)
+    return len(reached) == len(subset)
+
+
+def _canonicalize_fragment(subset, atoms, edges) -> list[dict]:
+    # Brute force the atom order with the smallest signature, fragments are small
+    best_signature = None
+    best_order = None
+    for order in itertools.permutations(subset):
+        relabel = {matchid: i for i, matchid in enumerate(order, 1)}
+        signature = (
+            tuple((str(atoms[m]["element"]), str(atoms[m]["origin"])) for m in order),
+            tuple(sorted((*sorted((relabel[a], relabel[b])), dist) for (a, b), dist in edges.items())),
+        )
+        if best_signature is None or signature < best_signature:
+            best_signature = signature
+            best_order = order
+
+    assert best_signature is not None and best_order is not None
+    canonical_atoms = {
+        i: {"element": atoms[m]["element"], "origin": atoms[m]["origin"], "matchid": i} for i, m in enumerate(best_order, 1)
+    }
+    return [{"atom1": canonical_atoms[a], "atom2": canonical_atoms[b], "distance": dist} for a, b, dist in best_signature[1]]
+
+
+def get_atom_statistics() -> dict[tuple[int, str], int]:
+    """Get cached frequencies of all (element, origin) combinations in data_points.
+
+    Expired statistics are refreshed in a background thread, until the first load finishes no statistics
+    are available and the joins stay unordered.
+    """
+    if (_atom_statistics is None or time.time() - _atom_statistics_time >= ATOM_STATISTICS_TTL) and _atom_statistics_lock.acquire(
+        blocking=False
+    ):
+        threading.Thread(target=_refresh_atom_statistics, name="atom-statistics", daemon=True).start()
+
+    return _atom_statistics or {}
+
+
+def _refresh_atom_statistics() -> None:
+    global _atom_statistics, _atom_statistics_time
+
+    try:
+        table = "data_points_encoded" if uses_compact_schema() else "data_points"
+        with get_database_handler(args.dbtype, db_params, replicas=replica_params) as handler:
+            # Sampling is sufficient for relative frequencies and avoids a full scan of data_points
+            if args.dbtype == "postgresql":
+                sample, where = " TABLESAMPLE SYSTEM (1)", ""
+            else:
+                # MySQL has no TABLESAMPLE, sample random id ranges (primary key range scans) instead
+                _, rows = handler.execute_query(f"SELECT MIN(id), MAX(id) FROM {table}")
+                min_id, max_id = rows[0]
+                if min_id is None:
+                    min_id = max_id = 0
+                starts = [
+                    random.randint(min_id, max(min_id, max_id - ATOM_STATISTICS_RANGE_SIZE))
+                    for _ in range(ATOM_STATISTICS_SAMPLE_RANGES)
+                ]
+                sample = ""
+                where = " WHERE " + " OR ".join(f"dp.id BETWEEN {start} AND {start + ATOM_STATISTICS_RANGE_SIZE - 1}" for start in starts)
+
+            if uses_compact_schema():
+                stats_query = f"""
+                    SELECT dp.element, o.name, COUNT(*)
+                    FROM data_points_encoded dp{sample}
+                    JOIN residue_names o ON o.code = dp.origin_code{where}
+                    GROUP BY dp.element, o.name
+                """
+            else:
+                stats_query = f"SELECT dp.element, dp.origin, COUNT(*) FROM data_points dp{sample}{where} GROUP BY dp.element, dp.origin"
+
+            _, rows = handler.execute_query(stats_query)
+        _atom_statistics = {(row[0], row[1]): int(row[2]) for row in rows}
+        app.logger.info(f"Loaded atom statistics for {len(_atom_statistics)} (element, origin) combinations")
+    except Exception as e:
+        app.logger.warning(f"Failed to load atom statistics, falling back to unordered joins: {str(e)}")
+        if _atom_statistics is None:
+            _atom_statistics = {}
+    finally:
+        _atom_statistics_time = time.time()
+        _atom_statistics_lock.release()
+
+
+def uses_compact_schema() -> bool:
+    """Whether data_points is the view of the dictionary encoded data_points_encoded table (compact schema)"""
+    global _compact_schema
+    if _compact_schema is None:
+        with get_database_handler(args.dbtype, db_params) as handler:
+            _compact_schema = bool(detect_compact_schema(handler))
+    return _compact_schema
+
+
+def get_origin_code(origin: str) -> int:
+    """Get the residue_names code of an origin (compact schema), -1 if it does not exist"""
+    if origin not in _origin_codes:
+        # Reload the codes, the residue may have been added by a later import
+        with get_database_handler(args.dbtype, db_params, replicas=replica_params) as handler:
+            _, rows = handler.execute_query("SELECT name, code FROM residue_names")
+        _origin_codes.update({row[0]: int(row[1]) for row in rows})
+    return _origin_codes.get(origin, -1)
+
+
+def get_atom_selectivities(atoms) -> dict[int, float]:
+    """Estimate the fraction of data_points matching each atom of the motif"""
+    stats = get_atom_statistics()
+    total = sum(stats.values())
+    if not total:
+        return {matchid: 1.0 for matchid in atoms}
+
+    selectivities = {}
+    for matchid, atom in atoms.items():
+        count = sum(
+            c
+            for (element, origin), c in stats.items()
+            if (atom["element"] is None or element == atom["element"]) and (atom["origin"] is None or origin == atom["origin"])
+        )
+        selectivities[matchid] = count / total
+    return selectivities
+
+
+def get_join_order(atoms, distances, selectivities) -> list[int]:
+    """Order the atoms most selective first, following the distance graph where possible"""
+    order = []
+    remaining = set(atoms)
+    while remaining:
+        joined = set(order)
+        connected = [m for m in remaining if any((p1 in joined and p2 == m) or (p2 in joined and p1 == m) for p1, p2 in distances)]
+        next_atom = min(connected or remaining, key=lambda m: (selectivities.get(m, 1.0), m))
+        order.append(next_atom)
+        remaining.remove(next_atom)
+    return order
+
+
+def _distance_condition(p1, p2, dist, tolerance=DEFAULT_DISTANCE_TOLERANCE) -> sql.Composed:
+    # Axis-aligned box test gives the planner usable ranges on the coordinates,
+    # the squared distance bounds avoid SQRT and POWER per candidate pair
+    ident1, ident2 = sql.Identifier(f"p{p1}"), sql.Identifier(f"p{p2}")
+    return sql.SQL("""
+        {1}.x BETWEEN {0}.x - {2} AND {0}.x + {2} AND
+        {1}.y BETWEEN {0}.y - {2} AND {0}.y + {2} AND
+        {1}.z BETWEEN {0}.z - {2} AND {0}.z + {2} AND
+        ({0}.x - {1}.x) * ({0}.x - {1}.x) +
+        ({0}.y - {1}.y) * ({0}.y - {1}.y) +
+        ({0}.z - {1}.z) * ({0}.z - {1}.z) BETWEEN {3} AND {4}
+        """).format(
+        ident1,
+        ident2,
+        sql.Literal(dist + tolerance),
+        sql.Literal(max(dist - tolerance, 0.0) ** 2),
+        sql.Literal((dist + tolerance) ** 2),
+    )
+
+
+def _data_points_table() -> sql.SQL:
+    # Search directly on the encoded table instead of the textual view with the compact schema
+    return sql.SQL("data_points_encoded" if uses_compact_schema() else "data_points")
+
+
+def _atom_conditions(atoms) -> list[sql.Composed]:
+    atom_conditions = []
+    for id, atom in atoms.items():
+        ident = sql.Identifier(f"p{id}")
+        if atom["element"] is not None:
+            atom_conditions.append(sql.SQL("{0}.element = {1}").format(ident, sql.Literal(atom["element"])))
+        if atom["origin"] is not None:
+            if uses_compact_schema():
+                atom_conditions.append(sql.SQL("{0}.origin_code = {1}").format(ident, sql.Literal(get_origin_code(atom["origin"]))))
+            else:
+                atom_conditions.append(sql.SQL("{0}.origin = {1}").format(ident, sql.Literal(atom["origin"])))
+    return atom_conditions
+
+
+def _join_distance_conditions(i, joined, distances, tolerance) -> list[sql.Composed]:
+    # Distance conditions between atom i and the already joined atoms, with the coordinate
+    # range on the newly joined atom i so it can use the (..., x) index
+    join_conditions = []
+    for (p1, p2), dist in distances.items():
+        if p1 == i and (p2 in joined or p2 == i):
+            join_conditions.append(_distance_condition(p2, p1, dist, tolerance))
+        elif p2 == i and p1 in joined:
+            join_conditions.append(_distance_condition(p1, p2, dist, tolerance))
+    return join_conditions
+
+
+def get_max_residue_radius() -> float:
+    """Largest radius of all residue_points (an index lookup), not cached so new imports are always covered"""
+    with get_database_handler(args.dbtype, db_params, replicas=replica_params) as handler:
+        _, rows = handler.execute_query("SELECT MAX(radius) FROM residue_points")
+    return float(rows[0][0] or 0.0)
+
+
+def _residue_distance_condition(r1, r2, dist, tolerance=DEFAULT_DISTANCE_TOLERANCE, max_radius=0.0) -> sql.Composed:
+    # All atoms lie within radius of their residue centroid, so the atom distance differs from the
+    # centroid distance by at most the sum of both radii, which widens the tolerance per residue pair.
+    # The box test on r2 is widened by the largest radius of all residues instead of its own, so it only
+    # depends on r1 and gives the planner usable ranges on the (..., x) index
+    ident1, ident2 = sql.Identifier(f"r{r1}"), sql.Identifier(f"r{r2}")
+    return sql.SQL("""
+        {1}.x BETWEEN {0}.x - ({4} + {0}.radius) AND {0}.x + ({4} + {0}.radius) AND
+        {1}.y BETWEEN {0}.y - ({4} + {0}.radius) AND {0}.y + ({4} + {0}.radius) AND
+        {1}.z BETWEEN {0}.z - ({4} + {0}.radius) AND {0}.z + ({4} + {0}.radius) AND
+        ({0}.x - {1}.x) * ({0}.x - {1}.x) +
+        ({0}.y - {1}.y) * ({0}.y - {1}.y) +
+        ({0}.z - {1}.z) * ({0}.z - {1}.z) <= ({2} + {0}.radius + {1}.radius) * ({2} + {0}.radius + {1}.radius) AND
+        ({3} - {0}.radius - {1}.radius <= 0 OR
+        ({0}.x - {1}.x) * ({0}.x - {1}.x) +
+        ({0}.y - {1}.y) * ({0}.y - {1}.y) +
+        ({0}.z - {1}.z) * ({0}.z - {1}.z) >= ({3} - {0}.radius - {1}.radius) * ({3} - {0}.radius - {1}.radius))
+        """).format(ident1, ident2, sql.Literal(dist + tolerance), sql.Literal(dist - tolerance), sql.Literal(dist + tolerance + max_radius))
+
+
+def generate_residue_search_query_sql(selected_pairs, limit=500, tolerance=DEFAULT_DISTANCE_TOLERANCE) -> sql.Composed:
+    """Search query matching the motif on residue_points first and refining to atoms of the candidate residues"""
+    atoms = {}
+    distances = {}
+    for pair in selected_pairs:
+        for atom in [pair["atom1"], pair["atom2"]]:
+            atoms[atom["matchid"]] = atom
+        distances[(pair["atom1"]["matchid"], pair["atom2"]["matchid"])] = pair["distance"]
+
+    # Coarse tier: match the residues of all motif atoms with widened tolerances, joined in the same
+    # selectivity order as the atoms
+    if USE_SELECTIVITY_JOIN_ORDER:
+        join_order = get_join_order(atoms, distances, get_atom_selectivities(atoms))
+    else:
+        join_order = sorted(atoms)
+    first = join_order[0]
+
+    max_radius = get_max_residue_radius()
+
+    residue_tables = sql.SQL("residue_points {0}").format(sql.Identifier(f"r{first}"))
+    joined = {first}
+    for i in join_order[1:]:
+        join_conditions = [sql.SQL("{0}.complex_data_id = {1}.complex_data_id").format(sql.Identifier(f"r{i}"), sql.Identifier(f"r{first}"))]
+        for (p1, p2), dist in distances.items():
+            if p1 == i and p2 in joined:
+                join_conditions.append(_residue_distance_condition(p2, p1, dist, tolerance, max_radius))
+            elif p2 == i and p1 in joined:
+                join_conditions.append(_residue_distance_condition(p1, p2, dist, tolerance, max_radius))
+        residue_tables += sql.SQL(" JOIN residue_points {0} ON ").format(sql.Identifier(f"r{i}")) + sql.SQL(" AND ").join(join_conditions)
+        joined.add(i)
+
+    residue_conditions = [
+        sql.SQL("{0}.origin = {1}").format(sql.Identifier(f"r{i}"), sql.Literal(atom["origin"]))
+        for i, atom in atoms.items()
+        if atom["origin"] is not None
+    ]
+
+    sql_query = sql.SQL("""
+        WITH candidates AS (
+        SELECT {first}.complex_data_id,
+            {range_columns}
+        FROM {residue_tables}
+        {residue_where}
+        )
+        SELECT cd.pdb_id,
+            {match_columns}
+        FROM candidates c JOIN complex_data cd ON cd.complex_data_id = c.complex_data_id""").format(
+        first=sql.Identifier(f"r{first}"),
+        range_columns=sql.SQL(", ").join(
+            sql.SQL("{0}.first_atom_id AS {1}, {0}.last_atom_id AS {2}").format(
+                sql.Identifier(f"r{i}"), sql.Identifier(f"first_{i}"), sql.Identifier(f"last_{i}")
+            )
+            for i in atoms
+        ),
+        residue_tables=residue_tables,
+        residue_where=sql.SQL("WHERE ") + sql.SQL(" AND ").join(residue_conditions) if residue_conditions else sql.SQL(""),
+        match_columns=sql.SQL(", ").join(sql.SQL("{}.id AS match_{}").format(sql.Identifier(f"p{i}"), sql.Literal(i)) for i in atoms.keys()),
+    )
+
+    # Atom tier: only the atoms within the id ranges of the candidate residues, with the exact distances
+    joined = set()
+    for i in sorted(atoms):
+        join_conditions = [
+            sql.SQL("{0}.complex_data_id = c.complex_data_id").format(sql.Identifier(f"p{i}")),
+            sql.SQL("{0}.id BETWEEN c.{1} AND c.{2}").format(sql.Identifier(f"p{i}"), sql.Identifier(f"first_{i}"), sql.Identifier(f"last_{i}")),
+        ]
+        join_conditions += _join_distance_conditions(i, joined, distances, tolerance)
+        sql_query += sql.SQL(" JOIN {0} {1} ON ").format(_data_points_table(), sql.Identifier(f"p{i}")) + sql.SQL(" AND ").join(join_conditions)
+        joined.add(i)
+
+    atom_conditions = _atom_conditions(atoms)
+    if atom_conditions:
+        sql_query += sql.SQL(" WHERE ") + sql.SQL(" AND ").join(atom_conditions)
+
+    if limit:
+        # Add LIMIT clause to the query
+        sql_query += sql.SQL(" LIMIT {0}").format(sql.Literal(limit))
+
+    return sql_query
+
+
+def generate_search_query_sql(selected_pairs, base_query=False, limit=500, tolerance=DEFAULT_DISTANCE_TOLERANCE) -> sql.Composed:
     atoms = {}
     distances = {}
     for pair in selected_pairs:
@@ -236,14 +798,35 @@ def generate_search_query_sql(selected_pairs, base_query=False, limit=500) -> sq
 
     num_points = len(atoms)
 
+    data_points_table = _data_points_table()
+    atom_conditions = _atom_conditions(atoms)
+
     if base_query:
+        # The base query keeps its flat form, as it is decomposed and hashed by the partition cache
         sql_query = sql.SQL("""
         SELECT p0.complex_data_id,
             {match_columns}
-        FROM data_points p0""").format(
+        FROM {data_points_table} p0""").format(
+            data_points_table=data_points_table,
             match_columns=sql.SQL(", ").join(sql.SQL("{}.id AS match_{}").format(sql.Identifier(f"p{i}"), sql.Literal(i)) for i in atoms.keys())
         )
-        join_table_alias = "p0"
+
+        for i in range(1, num_points + 1):
+            sql_query += sql.SQL(", {0} {1}").format(data_points_table, sql.Identifier(f"p{i}"))
+
+        sql_query += sql.SQL(" WHERE ")
+
+        conditions = []
+
+        for i in range(1, num_points + 1):
+            conditions.append(sql.SQL("{0}.complex_data_id = {1}.complex_data_id").format(sql.Identifier(f"p{i}"), sql.Identifier("p0")))
+
+        conditions += atom_conditions
+
+        for (p1, p2), dist in distances.items():
+            conditions.append(_distance_condition(p1, p2, dist, tolerance))
+
+        sql_query += sql.SQL(" AND ").join(conditions)
 
     else:
         sql_query = sql.SQL("""
@@ -252,46 +835,31 @@ def generate_search_query_sql(selected_pairs, base_query=False, limit=500) -> sq
         FROM complex_data cd""").format(
             match_columns=sql.SQL(", ").join(sql.SQL("{}.id AS match_{}").format(sql.Identifier(f"p{i}"), sql.Literal(i)) for i in atoms.keys())
         )
-        join_table_alias = "cd"
-
-    for i in range(1, num_points + 1):
-        sql_query += sql.SQL(", data_points {0}").format(sql.Identifier(f"p{i}"))
-
-    sql_query += sql.SQL(" WHERE ")
 
-    conditions = []
-
-    for i in range(1, num_points + 1):
-        conditions.append(sql.SQL("{0}.complex_data_id = {1}.complex_data_id").format(sql.Identifier(f"p{i}"), sql.Identifier(join_table_alias)))
-
-    for id, atom in atoms.items():
-        ident = sql.Identifier(f"p{id}")
-        if atom["element"] is not None:
-            conditions.append(sql.SQL("{0}.element = {1}").format(ident, sql.Literal(atom["element"])))
-        if atom["origin"] is not None:
-            conditions.append(sql.SQL("{0}.origin = {1}").format(ident, sql.Literal(atom["origin"])))
+        # Join the atoms as explicit JOINs, most selective first along the distance graph,
+        # and attach each distance predicate to the earliest join where both atoms are available
+        if USE_SELECTIVITY_JOIN_ORDER:
+            join_order = get_join_order(atoms, distances, get_atom_selectivities(atoms))
+        else:
+            join_order = sorted(atoms)
 
-    for (p1, p2), dist in distances.items():
-        conditions.append(
-            sql.SQL("""
-        ABS(SQRT(
-            POWER({0}.x - {1}.x, 2) +
-            POWER({0}.y - {1}.y, 2) +
-            POWER({0}.z - {1}.z, 2)
-        ) - {2}) <= 0.1
-        """).format(sql.Identifier(f"p{p1}"), sql.Identifier(f"p{p2}"), sql.Literal(dist))
-        )
+        joined = set()
+        for i in join_order:
+            join_conditions = [sql.SQL("{0}.complex_data_id = cd.complex_data_id").format(sql.Identifier(f"p{i}"))]
+            join_conditions += _join_distance_conditions(i, joined, distances, tolerance)
+            sql_query += sql.SQL(" JOIN {0} {1} ON ").format(data_points_table, sql.Identifier(f"p{i}")) + sql.SQL(" AND ").join(join_conditions)
+            joined.add(i)
 
-    sql_query += sql.SQL(" AND ").join(conditions)
+        if atom_conditions:
+            sql_query += sql.SQL(" WHERE ") + sql.SQL(" AND ").join(atom_conditions)
 
-    if not base_query and limit:
-        # Add LIMIT clause to the query
-        sql_query += sql.SQL(" LIMIT {0}").format(sql.Literal(limit))
+        if limit:
+            # Add LIMIT clause to the query
+            sql_query += sql.SQL(" LIMIT {0}").format(sql.Literal(limit))
 
     return sql_query
 
 
-
 @app.route("/search", methods=["POST"])
 def search():
     data = request.json
@@ -299,6 +867,8 @@ def search():
         return jsonify({"error": "No data received"}), 400
     selected_pairs = data.get("selected_pairs", [])  # The pairs to search for
     skip_execution = data.get("skip_execution", False)  # Skip execution and return SQL query only to display while query will be executed in the background
+    tolerance = data.get("tolerance", DEFAULT_DISTANCE_TOLERANCE)  # Allowed deviation of each distance
+    search_mode = data.get("search_mode", "atom")  # "atom" or "residue" (coarse residue level search with atom level refinement)
 
     app.logger.info(f"Search request - skip_execution: {skip_execution}")
     app.logger.debug(f"Selected pairs: {selected_pairs}")
@@ -306,13 +876,32 @@ def search():
     if not selected_pairs:
         return jsonify({"error": "No pairs selected"}), 400
 
+    if not isinstance(tolerance, (int, float)) or isinstance(tolerance, bool) or not 0 <= tolerance <= MAX_DISTANCE_TOLERANCE:
+        return jsonify({"error": f"Tolerance must be a number between 0 and {MAX_DISTANCE_TOLERANCE}"}), 400
+
+    if search_mode not in ("atom", "residue"):
+        return jsonify({"error": f"Invalid search mode: {search_mode}"}), 400
+
     try:
-        sql_query = get_extended_search_query(selected_pairs)
+        partition_keys = get_search_partition_keys(selected_pairs, tolerance)
+        sql_query = get_extended_search_query(selected_pairs, tolerance, search_mode, partition_keys)
         app.logger.debug(f"Generated SQL query: {sql_query}")
         if skip_execution:
             return jsonify({"sql_query": sqlparse.format(sql_query, reindent=True)})
 
-        with get_database_handler(args.dbtype, db_params) as handler:
+        # Estimate the total number of matches in parallel, in case the result limit is reached
+        # (skipped if all estimate slots are taken, so estimates do not pile up under load)
+        estimate_future = None
+        estimate_cancelled = threading.Event()
+        if ESTIMATE_MATCH_COUNT and _estimate_slots.acquire(blocking=False):
+            estimate_future = _estimate_executor.submit(
+                estimate_match_count, selected_pairs, partition_keys[0], tolerance, search_mode, estimate_cancelled
+            )
+            estimate_future.add_done_callback(lambda _: _estimate_slots.release())
+
+        # Queries creating a temporary table for the partition keys can not be executed on (PostgreSQL) standbys
+        is_multi_statement = len([q for q in sql_query.split(";") if q.strip()]) > 1
+        with get_database_handler(args.dbtype, db_params, replicas=None if is_multi_statement else replica_params) as handler:
             
             app.logger.debug("Executing SQL query")            
             
@@ -331,11 +920,34 @@ def search():
             req_time = time.perf_counter() - start_time
             app.logger.info(f"Search completed. Found {len(results)} results in {req_time:.2f} seconds.")
             handler.disconnect()
+
+            estimated_total = None
+            if estimate_future is not None:
+                if limit_reached:
+                    try:
+                        estimated_total = estimate_future.result(timeout=ESTIMATE_TIMEOUT)
+                        if estimated_total is not None:
+                            # The sample may have missed matching complexes, the result is a lower bound
+                            if estimated_total["estimate"] is not None:
+                                estimated_total["estimate"] = max(estimated_total["estimate"], len(results))
+                            estimated_total["lower"] = max(estimated_total["lower"], len(results))
+                            if estimated_total["upper"] is not None:
+                                estimated_total["upper"] = max(estimated_total["upper"], len(results))
+                        app.logger.info(f"Estimated total number of matches: {estimated_total}")
+                    except Exception as e:
+                        estimate_cancelled.set()
+                        app.logger.warning(f"Failed to estimate the total number of matches: {str(e)}")
+                else:
+                    # Skip the estimate if it has not started its search yet
+                    estimate_cancelled.set()
+                    estimate_future.cancel()
+
             return jsonify(
                 {
                     "sql_query": str(sql_query),
                     "results": results,
                     "limit_reached": limit_reached,
+                    "estimated_total": estimated_total,
                 }
             )
     except Exception as e:
@@ -0,0 +1,91 @@
+import struct
+import sys
+import zlib
+from array import array
+from typing import Any, Dict, List
+
+# Per complex columnar blob of all data_points, stored in complex_coordinates to load a
+# molecule with a single row read instead of one row per atom.
+#
+# Layout (little endian, zlib compressed):
+#   header:  magic (4s), version (B), num_atoms (I), num_names (I)
+#   columns: id (int32), x, y, z (float32), element (uint8), type, origin, group_name (uint16 name codes)
+#   names:   dictionary of all type/origin/group_name strings, utf-8, NUL separated
+
+BLOB_MAGIC = b"CMCB"
+BLOB_VERSION = 1
+_HEADER = struct.Struct("<4sBII")
+
+
+def _to_bytes(values: array) -> bytes:
+    if sys.byteorder == "big":
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def _from_bytes(typecode: str, data: memoryview, offset: int, count: int) -> tuple[array, int]:
+    values = array(typecode)
+    end = offset + values.itemsize * count
+    values.frombytes(data[offset:end])
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values, end
+
+
+def encode_coordinate_blob(ids: List[int], data_points: List[Dict[str, Any]]) -> bytes:
+    """Encode the data_points of one complex (and their database ids) as compressed columnar blob"""
+    if len(ids) != len(data_points):
+        raise ValueError(f"Got {len(ids)} ids for {len(data_points)} data points")
+
+    names: Dict[str, int] = {}
+
+    def name_code(name: str) -> int:
+        return names.setdefault(name, len(names))
+
+    columns = [
+        array("i", ids),
+        array("f", (point["x"] for point in data_points)),
+        array("f", (point["y"] for point in data_points)),
+        array("f", (point["z"] for point in data_points)),
+        array("B", (point["element"] for point in data_points)),
+        array("H", (name_code(point["type"]) for point in data_points)),
+        array("H", (name_code(point["origin"]) for point in data_points)),
+        array("H", (name_code(point["group_name"]) for point in data_points)),
+    ]
+
+    payload = _HEADER.pack(BLOB_MAGIC, BLOB_VERSION, len(ids), len(names))
+    payload += b"".join(_to_bytes(column) for column in columns)
+    payload += "\0".join(names).encode("utf-8")
+    return zlib.compress(payload)
+
+
+def decode_coordinate_blob(blob: bytes) -> Dict[str, list]:
+    """Decode a coordinate blob into its columns (id, element, type, origin, group_name, x, y, z)"""
+    data = memoryview(zlib.decompress(blob))
+    magic, version, num_atoms, num_names = _HEADER.unpack_from(data)
+    if magic != BLOB_MAGIC or version != BLOB_VERSION:
+        raise ValueError(f"Unsupported coordinate blob (magic {magic!r}, version {version})")
+
+    offset = _HEADER.size
+    ids, offset = _from_bytes("i", data, offset, num_atoms)
+    x, offset = _from_bytes("f", data, offset, num_atoms)
+    y, offset = _from_bytes("f", data, offset, num_atoms)
+    z, offset = _from_bytes("f", data, offset, num_atoms)
+    elements, offset = _from_bytes("B", data, offset, num_atoms)
+    types, offset = _from_bytes("H", data, offset, num_atoms)
+    origins, offset = _from_bytes("H", data, offset, num_atoms)
+    groups, offset = _from_bytes("H", data, offset, num_atoms)
+    names = bytes(data[offset:]).decode("utf-8").split("\0") if num_names else []
+
+    return {
+        "id": ids.tolist(),
+        "element": elements.tolist(),
+        "type": [names[code] for code in types],
+        "origin": [names[code] for code in origins],
+        "group_name": [names[code] for code in groups],
+        # float32 storage, round to the coordinate precision of PDB files
+        "x": [round(v, 3) for v in x],
+        "y": [round(v, 3) for v in y],
+        "z": [round(v, 3) for v in z],
+    }
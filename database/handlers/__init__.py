@@ -1,10 +1,20 @@
-from typing import Dict, Any
+from typing import Dict, Any, List, Optional
 from .base_handler import DatabaseHandler
 from .postgres_handler import PostgresHandler
 from .mysql_handler import MySQLHandler
+from .replica_router import ReplicaRouter, RoutedHandler
 
-def get_database_handler(db_type: str, db_params: Dict[str, Any]) -> DatabaseHandler:
-    """Factory function to get the appropriate database handler"""
+# Routers are kept per replica set, to track outstanding handlers and node health across requests
+_replica_routers: Dict[tuple, ReplicaRouter] = {}
+
+
+def get_database_handler(
+    db_type: str, db_params: Dict[str, Any], replicas: Optional[List[Dict[str, Any]]] = None
+) -> DatabaseHandler:
+    """Factory function to get the appropriate database handler
+
+    If replicas are given (for read-only usage), the handler is routed across them and falls back to db_params as primary.
+    """
     handlers = {
         'postgresql': PostgresHandler,
         'mysql': MySQLHandler
@@ -13,5 +23,11 @@ def get_database_handler(db_type: str, db_params: Dict[str, Any]) -> DatabaseHan
     handler_class = handlers.get(db_type.lower())
     if not handler_class:
         raise ValueError(f"Unsupported database type: {db_type}")
-    
-    return handler_class(db_params) 
\ No newline at end of file
+
+    if replicas:
+        key = (db_type.lower(), tuple(sorted(db_params.items())), tuple(tuple(sorted(r.items())) for r in replicas))
+        if key not in _replica_routers:
+            _replica_routers[key] = ReplicaRouter(handler_class, db_params, replicas)
+        return _replica_routers[key].get_handler()
+
+    return handler_class(db_params) 
@@ -20,7 +20,7 @@ class MySQLHandler(DatabaseHandler):
                 "collation": "utf8mb4_general_ci",
                 "use_unicode": True,
                 "connect_timeout": 60,  # 60 seconds timeout
-                "pool_name": "mypool",
+                "pool_name": f"mypool_{self.db_params.get('host')}_{self.db_params.get('port', 3306)}",  # One pool per node
                 "pool_size": 5,
                 "get_warnings": True,
                 "raise_on_warnings": True,
@@ -0,0 +1,184 @@
+import threading
+import time
+from typing import Any, Dict, List, Optional, Type
+
+from .base_handler import DatabaseHandler
+from .mysql_handler import MySQLHandler
+
+
+class ReplicaNode:
+    def __init__(self, db_params: Dict[str, Any], is_primary: bool = False):
+        self.db_params = db_params
+        self.is_primary = is_primary
+        self.outstanding = 0  # Number of connected handlers using this node
+        self.healthy = True
+        self.lag: Optional[float] = None  # Replication lag in seconds, None if unknown
+        self.last_check = 0.0
+
+    def __repr__(self) -> str:
+        return f"ReplicaNode({self.db_params.get('host')}:{self.db_params.get('port')}, primary={self.is_primary})"
+
+
+class ReplicaRouter:
+    """Routes read-only handlers across replica nodes.
+
+    Each handler connects to the healthy replica with the least outstanding handlers whose replication lag
+    is below max_replica_lag. The replicas are checked by a background thread, nodes failing to connect are
+    skipped until their next health check, the primary is used if no replica is available.
+    """
+
+    def __init__(
+        self,
+        handler_class: Type[DatabaseHandler],
+        primary_params: Dict[str, Any],
+        replica_params: List[Dict[str, Any]],
+        max_replica_lag: float = 30.0,
+        health_check_interval: float = 10.0,
+    ):
+        self.handler_class = handler_class
+        self.primary = ReplicaNode(primary_params, is_primary=True)
+        self.replicas = [ReplicaNode(params) for params in replica_params]
+        self.max_replica_lag = max_replica_lag
+        self.health_check_interval = health_check_interval
+        self._lock = threading.Lock()
+        self._checker: Optional[threading.Thread] = None
+
+    def get_handler(self) -> "RoutedHandler":
+        return RoutedHandler(self)
+
+    def start_health_checks(self) -> None:
+        """Start the background thread checking the replicas, so requests never wait for a health check"""
+        with self._lock:
+            if self._checker is not None or not self.replicas:
+                return
+            self._checker = threading.Thread(target=self._run_health_checks, name="replica-health-check", daemon=True)
+            self._checker.start()
+
+    def _run_health_checks(self) -> None:
+        while True:
+            for node in self.replicas:
+                self.check_node(node)
+            time.sleep(self.health_check_interval)
+
+    def check_node(self, node: ReplicaNode) -> None:
+        """Check if the node is reachable and update its replication lag"""
+        handler = self.handler_class(node.db_params)
+        try:
+            if isinstance(handler, MySQLHandler):
+                lag = self._mysql_replica_lag(handler)
+            else:
+                # Without pending WAL the replica is up to date, even if the last replayed transaction is old
+                _, rows = handler.execute_query(
+                    """
+                    SELECT CASE
+                        WHEN NOT pg_is_in_recovery() THEN 0
+                        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+                    END
+                    """
+                )
+                lag = rows[0][0]
+            healthy = True
+        except Exception:
+            lag, healthy = node.lag, False
+        finally:
+            handler.disconnect()
+
+        with self._lock:
+            node.lag = float(lag) if lag is not None else None
+            node.healthy = healthy
+            node.last_check = time.time()
+
+    @staticmethod
+    def _mysql_replica_lag(handler: MySQLHandler) -> float:
+        conn = handler.get_connection()
+        try:
+            with conn.cursor(dictionary=True) as cursor:
+                cursor.execute("SHOW REPLICA STATUS")
+                status = cursor.fetchone()
+        except Exception:
+            # MySQL before 8.0.22 and MariaDB before 10.5.1
+            with conn.cursor(dictionary=True) as cursor:
+                cursor.execute("SHOW SLAVE STATUS")
+                status = cursor.fetchone()
+        if not status:
+            return 0.0  # Not a replica
+
+        # MariaDB (and MySQL before 8.0.22) report Seconds_Behind_Master
+        column = "Seconds_Behind_Source" if "Seconds_Behind_Source" in status else "Seconds_Behind_Master"
+        lag = status.get(column)
+        # NULL if replication is not running
+        return float("inf") if lag is None else float(lag)
+
+    def candidates(self) -> List[ReplicaNode]:
+        """Get the usable replicas ordered by outstanding handlers, followed by the primary"""
+        self.start_health_checks()
+        with self._lock:
+            usable = [
+                node
+                for node in self.replicas
+                if node.healthy and (node.lag is None or node.lag <= self.max_replica_lag)
+            ]
+            usable.sort(key=lambda node: node.outstanding)
+        return usable + [self.primary]
+
+    def acquire(self, node: ReplicaNode) -> None:
+        with self._lock:
+            node.outstanding += 1
+
+    def release(self, node: ReplicaNode) -> None:
+        with self._lock:
+            node.outstanding -= 1
+
+    def mark_unhealthy(self, node: ReplicaNode) -> None:
+        with self._lock:
+            node.healthy = False
+            node.last_check = time.time()
+
+
+class RoutedHandler(DatabaseHandler):
+    """Handler connecting to the node selected by a ReplicaRouter, failing over to the next node on connection errors"""
+
+    def __init__(self, router: ReplicaRouter):
+        super().__init__(router.primary.db_params)
+        self.router = router
+        self._handler: Optional[DatabaseHandler] = None
+        self._node: Optional[ReplicaNode] = None
+
+    def connect(self) -> Any:
+        if self._handler is not None:
+            return self._handler.get_connection()
+
+        last_error: Optional[Exception] = None
+        for node in self.router.candidates():
+            handler = self.router.handler_class(node.db_params)
+            try:
+                connection = handler.get_connection()
+            except Exception as e:
+                last_error = e
+                if not node.is_primary:
+                    self.router.mark_unhealthy(node)
+                continue
+
+            self.router.acquire(node)
+            self._handler = handler
+            self._node = node
+            self.db_params = node.db_params
+            return connection
+
+        raise ConnectionError(f"No database node available: {last_error}")
+
+    def disconnect(self) -> None:
+        if self._handler is not None and self._node is not None:
+            self._handler.disconnect()
+            self.router.release(self._node)
+            self._handler = None
+            self._node = None
+
+    def get_connection(self) -> Any:
+        return self.connect()
+
+    def execute_query(self, query: str, params: Optional[tuple] = None) -> tuple[list[str], list[tuple]]:
+        self.connect()
+        assert self._handler is not None
+        return self._handler.execute_query(query, params)
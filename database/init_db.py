@@ -1,7 +1,48 @@
+from typing import Optional
+
+from psycopg import sql
+
 from database.handlers import DatabaseHandler, PostgresHandler, MySQLHandler
 
+# Lookup tables of the dictionary encoded data_points columns (compact schema)
+NAME_LOOKUP_TABLES = {
+    "type": "atom_type_names",
+    "origin": "residue_names",
+    "group_name": "chain_names",
+}
+
+
+def detect_compact_schema(db_handler: DatabaseHandler) -> Optional[bool]:
+    """Whether the database uses the compact schema, None if data_points has not been created yet"""
+    schema = "DATABASE()" if isinstance(db_handler, MySQLHandler) else "current_schema()"
+    _, rows = db_handler.execute_query(f"""
+        SELECT table_name FROM information_schema.tables
+        WHERE table_schema = {schema} AND table_name IN ('data_points', 'data_points_encoded')
+    """)
+    table_names = {row[0] for row in rows}
+    if "data_points_encoded" in table_names:
+        return True
+    if "data_points" in table_names:
+        return False
+    return None
+
+
+def init_db(
+    db_handler: DatabaseHandler,
+    enable_rdkit: bool = False,
+    partitioning: Optional[str] = None,
+    num_partitions: int = 16,
+    partition_range_size: int = 100_000,
+    compact_schema: bool = False,
+) -> bool:
+    """Create the tables and indexes, returns whether the database uses the compact schema.
+
+    compact_schema is only applied to a new database, the schema of an existing database is detected.
+    """
+    detected_compact_schema = detect_compact_schema(db_handler)
+    if detected_compact_schema is not None:
+        compact_schema = detected_compact_schema
 
-def init_db(db_handler: DatabaseHandler, enable_rdkit: bool = False) -> None:
     conn = db_handler.get_connection()
     with conn.cursor() as cur:
         if enable_rdkit and isinstance(db_handler, PostgresHandler):
@@ -36,54 +77,212 @@ def init_db(db_handler: DatabaseHandler, enable_rdkit: bool = False) -> None:
                 );""")
 
         # Create data_points table with reference to complex_data
+        # (optionally partitioned by complex_data_id, which then has to be part of the primary key)
+        if partitioning is not None and partitioning not in ("hash", "range"):
+            raise ValueError(f"Invalid partitioning: {partitioning}")
+
+        # With the compact schema the columns type, origin and group_name are stored as codes of lookup tables
+        # in data_points_encoded, and data_points is a view providing the textual columns
+        table = "data_points_encoded" if compact_schema else "data_points"
+
+        if isinstance(db_handler, MySQLHandler):
+            # MySQL syntax (partitioned InnoDB tables do not support foreign keys)
+            if compact_schema:
+                name_columns = """type_code SMALLINT NOT NULL,
+                    origin_code SMALLINT NOT NULL,
+                    group_code SMALLINT NOT NULL,"""
+            else:
+                name_columns = """type VARCHAR(255) NOT NULL,
+                    origin VARCHAR(255) NOT NULL,
+                    group_name VARCHAR(255) NOT NULL,"""
+
+            if partitioning == "hash":
+                keys = "PRIMARY KEY (id, complex_data_id)"
+                partition_clause = f"PARTITION BY HASH (complex_data_id) PARTITIONS {num_partitions}"
+            elif partitioning == "range":
+                keys = "PRIMARY KEY (id, complex_data_id)"
+                partition_clause = "PARTITION BY RANGE (complex_data_id) ({}, PARTITION p_max VALUES LESS THAN MAXVALUE)".format(
+                    ", ".join(f"PARTITION p{i} VALUES LESS THAN ({(i + 1) * partition_range_size})" for i in range(num_partitions))
+                )
+            else:
+                keys = "PRIMARY KEY (id), FOREIGN KEY (complex_data_id) REFERENCES complex_data(complex_data_id)"
+                partition_clause = ""
+            cur.execute(f"""
+                CREATE TABLE IF NOT EXISTS {table} (
+                    id INT AUTO_INCREMENT,
+                    complex_data_id INT NOT NULL,
+                    element SMALLINT NOT NULL,
+                    {name_columns}
+                    x FLOAT NOT NULL,
+                    y FLOAT NOT NULL,
+                    z FLOAT NOT NULL,
+                    {keys}
+                ) CHARACTER SET utf8mb4 COLLATE utf8mb4_general_ci
+                {partition_clause};
+            """)
+        else:
+            # PostgreSQL syntax
+            if compact_schema:
+                name_columns = """type_code SMALLINT NOT NULL,
+                    origin_code SMALLINT NOT NULL,
+                    group_code SMALLINT NOT NULL,"""
+            else:
+                name_columns = """type TEXT NOT NULL,
+                    origin TEXT NOT NULL,
+                    group_name TEXT NOT NULL,"""
+
+            cur.execute(f"""
+                CREATE TABLE IF NOT EXISTS {table} (
+                    id SERIAL,
+                    complex_data_id INTEGER NOT NULL,
+                    element SMALLINT NOT NULL,
+                    {name_columns}
+                    x REAL NOT NULL,
+                    y REAL NOT NULL,
+                    z REAL NOT NULL,
+                    {"PRIMARY KEY (id, complex_data_id)" if partitioning else "PRIMARY KEY (id)"},
+                    FOREIGN KEY (complex_data_id) REFERENCES complex_data(complex_data_id)
+                ){f" PARTITION BY {partitioning.upper()} (complex_data_id)" if partitioning else ""};
+            """)
+
+            if partitioning == "hash":
+                for i in range(num_partitions):
+                    cur.execute(f"""
+                        CREATE TABLE IF NOT EXISTS {table}_p{i} PARTITION OF {table}
+                        FOR VALUES WITH (MODULUS {num_partitions}, REMAINDER {i});
+                    """)
+            elif partitioning == "range":
+                for i in range(num_partitions):
+                    cur.execute(f"""
+                        CREATE TABLE IF NOT EXISTS {table}_p{i} PARTITION OF {table}
+                        FOR VALUES FROM ({i * partition_range_size}) TO ({(i + 1) * partition_range_size});
+                    """)
+                cur.execute(f"CREATE TABLE IF NOT EXISTS {table}_p_default PARTITION OF {table} DEFAULT;")
+
+            if partitioning:
+                # All data_points aliases of a search are joined on complex_data_id, so the joins can be done per partition
+                db_name = db_handler.db_params.get("dbname")
+                cur.execute(sql.SQL("ALTER DATABASE {} SET enable_partitionwise_join = on;").format(sql.Identifier(db_name)))
+                cur.execute(sql.SQL("ALTER DATABASE {} SET enable_partitionwise_aggregate = on;").format(sql.Identifier(db_name)))
+
+        if compact_schema:
+            # Lookup tables for the codes and view with the textual interface of data_points
+            for lookup_table in NAME_LOOKUP_TABLES.values():
+                if isinstance(db_handler, MySQLHandler):
+                    cur.execute(f"""
+                        CREATE TABLE IF NOT EXISTS {lookup_table} (
+                            code SMALLINT AUTO_INCREMENT PRIMARY KEY,
+                            name VARCHAR(255) UNIQUE NOT NULL
+                        ) CHARACTER SET utf8mb4 COLLATE utf8mb4_general_ci;
+                    """)
+                else:
+                    cur.execute(f"""
+                        CREATE TABLE IF NOT EXISTS {lookup_table} (
+                            code SMALLSERIAL PRIMARY KEY,
+                            name TEXT UNIQUE NOT NULL
+                        );
+                    """)
+
+            cur.execute(f"""
+                CREATE OR REPLACE VIEW data_points AS
+                SELECT dp.id, dp.complex_data_id, dp.element,
+                    t.name AS type, o.name AS origin, g.name AS group_name,
+                    dp.x, dp.y, dp.z
+                FROM data_points_encoded dp
+                JOIN {NAME_LOOKUP_TABLES["type"]} t ON t.code = dp.type_code
+                JOIN {NAME_LOOKUP_TABLES["origin"]} o ON o.code = dp.origin_code
+                JOIN {NAME_LOOKUP_TABLES["group_name"]} g ON g.code = dp.group_code;
+            """)
+
+        # Create residue_points table with one pseudo atom (side chain centroid) per residue for the coarse search,
+        # first_atom_id and last_atom_id give the id range of its data_points
         if isinstance(db_handler, MySQLHandler):
             # MySQL syntax
             cur.execute("""
-                CREATE TABLE IF NOT EXISTS data_points (
+                CREATE TABLE IF NOT EXISTS residue_points (
                     id INT AUTO_INCREMENT PRIMARY KEY,
                     complex_data_id INT NOT NULL,
-                    element SMALLINT NOT NULL,
-                    type VARCHAR(255) NOT NULL,
                     origin VARCHAR(255) NOT NULL,
                     group_name VARCHAR(255) NOT NULL,
+                    first_atom_id INT NOT NULL,
+                    last_atom_id INT NOT NULL,
                     x FLOAT NOT NULL,
                     y FLOAT NOT NULL,
                     z FLOAT NOT NULL,
+                    radius FLOAT NOT NULL,
                     FOREIGN KEY (complex_data_id) REFERENCES complex_data(complex_data_id)
                 ) CHARACTER SET utf8mb4 COLLATE utf8mb4_general_ci;
             """)
         else:
             # PostgreSQL syntax
             cur.execute("""
-                CREATE TABLE IF NOT EXISTS data_points (
+                CREATE TABLE IF NOT EXISTS residue_points (
                     id SERIAL PRIMARY KEY,
                     complex_data_id INTEGER NOT NULL,
-                    element SMALLINT NOT NULL,
-                    type TEXT NOT NULL,
                     origin TEXT NOT NULL,
                     group_name TEXT NOT NULL,
+                    first_atom_id INTEGER NOT NULL,
+                    last_atom_id INTEGER NOT NULL,
                     x REAL NOT NULL,
                     y REAL NOT NULL,
                     z REAL NOT NULL,
+                    radius REAL NOT NULL,
+                    FOREIGN KEY (complex_data_id) REFERENCES complex_data(complex_data_id)
+                );
+            """)
+
+        # Create complex_coordinates table holding one compressed coordinate blob per complex
+        if isinstance(db_handler, MySQLHandler):
+            # MySQL syntax
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS complex_coordinates (
+                    complex_data_id INT PRIMARY KEY,
+                    num_atoms INT NOT NULL,
+                    data LONGBLOB NOT NULL,
+                    FOREIGN KEY (complex_data_id) REFERENCES complex_data(complex_data_id)
+                ) CHARACTER SET utf8mb4 COLLATE utf8mb4_general_ci;
+            """)
+        else:
+            # PostgreSQL syntax
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS complex_coordinates (
+                    complex_data_id INTEGER PRIMARY KEY,
+                    num_atoms INTEGER NOT NULL,
+                    data BYTEA NOT NULL,
                     FOREIGN KEY (complex_data_id) REFERENCES complex_data(complex_data_id)
                 );
             """)
 
         # Create indexes (syntax is the same for both)
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_data_points_complex_data_id ON data_points (complex_data_id);")
+        origin_column = "origin_code" if compact_schema else "origin"
+        cur.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_complex_data_id ON {table} (complex_data_id);")
+        # Supports the coordinate box prefilter of the distance conditions in search queries
+        cur.execute(
+            f"CREATE INDEX IF NOT EXISTS {table}_complex_data_id_x_idx ON {table} (complex_data_id, element, {origin_column}, x);"
+        )
+        # Replaced by the index above, which covers its columns as prefix
+        if isinstance(db_handler, MySQLHandler):
+            cur.execute(f"DROP INDEX IF EXISTS {table}_complex_data_id_idx ON {table};")
+        else:
+            cur.execute(f"DROP INDEX IF EXISTS {table}_complex_data_id_idx;")
         cur.execute(
-            "CREATE INDEX IF NOT EXISTS data_points_complex_data_id_idx ON data_points (complex_data_id, element, origin);"
+            "CREATE INDEX IF NOT EXISTS residue_points_complex_data_id_idx ON residue_points (complex_data_id, origin, x);"
         )
+        # Answers MAX(radius) for the residue box tests without a scan
+        cur.execute("CREATE INDEX IF NOT EXISTS residue_points_radius_idx ON residue_points (radius);")
         cur.execute("CREATE INDEX IF NOT EXISTS idx_complex_data_pdb_id ON complex_data (pdb_id);")
         
         # Analyze tables
         if isinstance(db_handler, PostgresHandler):
             cur.execute("ANALYZE complex_data;")
-            cur.execute("ANALYZE data_points;")
+            cur.execute(f"ANALYZE {table};")
+            cur.execute("ANALYZE residue_points;")
         elif isinstance(db_handler, MySQLHandler):
-            cur.execute("ANALYZE TABLE data_points PERSISTENT FOR ALL;")
+            cur.execute(f"ANALYZE TABLE {table} PERSISTENT FOR ALL;")
+            cur.execute("ANALYZE TABLE residue_points PERSISTENT FOR ALL;")
             cur.execute("ANALYZE TABLE complex_data PERSISTENT FOR ALL;")
 
     conn.commit()
+    return compact_schema
 
 
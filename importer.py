@@ -1,13 +1,22 @@
 import os
 import gzip
+import multiprocessing
 import argparse
+import time
 from dotenv import load_dotenv
-from database.handlers import get_database_handler
-from pdb_import.db_importer import import_pdb_to_db
+from database.handlers import DatabaseHandler, PostgresHandler, get_database_handler
+from pdb_import.db_importer import (
+    build_coordinate_blobs,
+    build_residue_points,
+    clear_name_code_cache,
+    commit_name_codes,
+    import_pdb_to_db,
+    parse_data_points,
+)
 from database.init_db import init_db
-from typing import Dict, Any
+from typing import Dict, Any, Iterator, List, Optional, Set, Tuple
 
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
 
 
 def read_pdb_file(filename: str, file_path: str) -> str:
@@ -22,36 +31,221 @@ def read_pdb_file(filename: str, file_path: str) -> str:
     return pdb_content
 
 
-def process_file(file_path: str, db_params: Dict[str, Any], db_type: str, enable_rdkit: bool) -> None:
-    # Create a new database handler for this process
-    db_handler = get_database_handler(db_type, db_params)
-    
-    filename = os.path.basename(file_path)
-    pdb_content = read_pdb_file(filename, file_path)
-    pdb_identifier = os.path.splitext(filename)[0]  # Use filename without extension as pdb_identifier
+class ConcurrencyController:
+    """Adapts the number of concurrently imported batches to the observed database latency and lock waits.
+
+    The latency is the database time per inserted atom, compared to its exponential moving average
+    (baseline). The limit grows by one per batch that is not much slower than the baseline and is halved
+    if it is or if transactions are waiting for locks (additive increase, multiplicative decrease).
+    As the baseline follows the latency, the limit recovers once the latency stops rising.
+    """
+
+    def __init__(self, max_workers: int, latency_factor: float = 2.0, smoothing: float = 0.1):
+        self.max_workers = max_workers
+        self.latency_factor = latency_factor
+        self.smoothing = smoothing
+        self.limit = max(1, max_workers // 4)
+        self.baseline: Optional[float] = None  # Moving average of the seconds per atom
+        self._completed_since_decrease = 0
+
+    def update(self, seconds_per_atom: Optional[float], lock_waits: int) -> None:
+        """Update the limit after a batch, seconds_per_atom is None if the batch gave no latency sample"""
+        self._completed_since_decrease += 1
+
+        slow = False
+        if seconds_per_atom is not None:
+            if self.baseline is None:
+                self.baseline = seconds_per_atom
+            slow = seconds_per_atom > self.baseline * self.latency_factor
+            self.baseline += self.smoothing * (seconds_per_atom - self.baseline)
+
+        if lock_waits > 0 or slow:
+            # Decrease at most once per window, the batches in flight were submitted with the old limit
+            if self._completed_since_decrease >= self.limit:
+                self.limit = max(1, self.limit // 2)
+                self._completed_since_decrease = 0
+        elif self.limit < self.max_workers:
+            self.limit += 1
+
+
+# Database handler of the worker process, kept open for its batches while the limit allows
+_worker_handler: Optional[DatabaseHandler] = None
+_worker_connected = False
+
+# Shared by all worker processes: number of open worker connections and the current concurrency limit
+_open_connections: Any = None
+_connection_limit: Any = None
+
+
+def _init_worker(db_params: Dict[str, Any], db_type: str, open_connections: Any, connection_limit: Any) -> None:
+    global _worker_handler, _open_connections, _connection_limit
+    _worker_handler = get_database_handler(db_type, db_params)
+    _open_connections = open_connections
+    _connection_limit = connection_limit
+
+
+def _count_connection() -> None:
+    global _worker_connected
+    if not _worker_connected:
+        with _open_connections.get_lock():
+            _open_connections.value += 1
+        _worker_connected = True
+
+
+def _release_surplus_connection() -> None:
+    """Close the connection of the worker if more connections are open than batches may be in flight"""
+    global _worker_connected
+    assert _worker_handler is not None
+    with _open_connections.get_lock():
+        if _open_connections.value <= _connection_limit.value:
+            return
+        _open_connections.value -= 1
+    _worker_connected = False
+    _worker_handler.disconnect()
+
+
+def _rollback(db_handler: DatabaseHandler) -> None:
     try:
-        import_pdb_to_db(pdb_content, pdb_identifier, db_handler, enable_rdkit)
-    finally:
+        db_handler.get_connection().rollback()
+    except Exception:
+        # Connection is broken, reconnect on next use
         db_handler.disconnect()
 
 
-def import_pdb_files(folder_path: str, db_params: Dict[str, Any], db_type: str, enable_rdkit: bool) -> None:
-    fp_list = []
-    for filename in os.listdir(folder_path):
-        file_path = os.path.join(folder_path, filename)
-        if filename.endswith(".pdb") or filename.endswith(".gz"):
-            fp_list.append(file_path)
+def read_file(file_path: str) -> Tuple[str, str]:
+    """Read a PDB file, returns its identifier (filename without extension) and content"""
+    filename = os.path.basename(file_path)
+    pdb_content = read_pdb_file(filename, file_path)
+    return os.path.splitext(filename)[0], pdb_content
+
+
+def process_file(file_path: str, db_handler: DatabaseHandler, enable_rdkit: bool, compact_schema: bool = False) -> None:
+    pdb_identifier, pdb_content = read_file(file_path)
+    import_pdb_to_db(pdb_content, pdb_identifier, db_handler, enable_rdkit, compact_schema)
+
+
+def process_batch(file_paths: List[str], enable_rdkit: bool, compact_schema: bool = False) -> Tuple[Optional[float], List[str]]:
+    """Import a batch of files in one transaction, returns the database seconds per atom and the errors.
+
+    The seconds per atom exclude reading and parsing the files, they are None if the batch failed
+    and its files were imported one by one.
+    """
+    assert _worker_handler is not None
+    _count_connection()
+    seconds_per_atom = None
+    errors = []
+    try:
+        pdb_files = []
+        for file_path in file_paths:
+            pdb_identifier, pdb_content = read_file(file_path)
+            pdb_files.append((pdb_identifier, pdb_content, parse_data_points(pdb_content)))
+
+        start_time = time.perf_counter()
+        if compact_schema:
+            # New names of the whole batch are committed in a short transaction of their own, so concurrent
+            # batches are not blocked on the lookup tables until this batch commits
+            commit_name_codes(_worker_handler, [point for _, _, data_points in pdb_files for point in data_points])
 
-    with ProcessPoolExecutor(max_workers=30) as executor:
-        futures = [
-            executor.submit(process_file, file_path, db_params, db_type, enable_rdkit)
-            for file_path in fp_list
-        ]
-        for future in as_completed(futures):
+        for pdb_identifier, pdb_content, data_points in pdb_files:
+            import_pdb_to_db(
+                pdb_content, pdb_identifier, _worker_handler, enable_rdkit, compact_schema, commit=False, data_points=data_points
+            )
+        _worker_handler.get_connection().commit()
+        num_atoms = sum(len(data_points) for _, _, data_points in pdb_files)
+        seconds_per_atom = (time.perf_counter() - start_time) / max(1, num_atoms)
+    except Exception:
+        # Import the files of the failed batch one by one, so a single invalid file does not discard the others
+        _rollback(_worker_handler)
+        clear_name_code_cache()
+        for file_path in file_paths:
             try:
-                future.result()
+                process_file(file_path, _worker_handler, enable_rdkit, compact_schema)
             except Exception as e:
-                print(f"An error occurred: {e}")
+                _rollback(_worker_handler)
+                errors.append(f"{file_path}: {e}")
+    finally:
+        _release_surplus_connection()
+
+    return seconds_per_atom, errors
+
+
+def iter_pdb_files(folder_path: str) -> Iterator[str]:
+    with os.scandir(folder_path) as entries:
+        for entry in entries:
+            if entry.name.endswith(".pdb") or entry.name.endswith(".gz"):
+                yield entry.path
+
+
+def iter_batches(file_paths: Iterator[str], batch_size: int) -> Iterator[List[str]]:
+    batch = []
+    for file_path in file_paths:
+        batch.append(file_path)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def count_lock_waits(db_handler: DatabaseHandler) -> int:
+    """Number of transactions currently waiting for a lock"""
+    if isinstance(db_handler, PostgresHandler):
+        _, rows = db_handler.execute_query("SELECT COUNT(*) FROM pg_stat_activity WHERE wait_event_type = 'Lock'")
+    else:
+        _, rows = db_handler.execute_query("SELECT COUNT(*) FROM information_schema.innodb_trx WHERE trx_state = 'LOCK WAIT'")
+    # End the transaction, otherwise PostgreSQL keeps returning the pg_stat_activity snapshot of the first poll
+    db_handler.get_connection().commit()
+    return int(rows[0][0])
+
+
+def import_pdb_files(
+    folder_path: str,
+    db_params: Dict[str, Any],
+    db_type: str,
+    enable_rdkit: bool,
+    compact_schema: bool = False,
+    max_workers: int = 30,
+    files_per_batch: int = 20,
+) -> None:
+    # Stream the folder and only keep as many batches in flight as the controller allows
+    batches = iter_batches(iter_pdb_files(folder_path), files_per_batch)
+    controller = ConcurrencyController(max_workers)
+    monitor_handler = get_database_handler(db_type, db_params)
+
+    # Workers close their connection after a batch while more connections are open than the limit,
+    # so the number of connections follows the limit instead of the number of processes
+    open_connections = multiprocessing.Value("i", 0)
+    connection_limit = multiprocessing.Value("i", controller.limit)
+
+    try:
+        with ProcessPoolExecutor(
+            max_workers=max_workers, initializer=_init_worker, initargs=(db_params, db_type, open_connections, connection_limit)
+        ) as executor:
+            pending: Set[Future] = set()
+            exhausted = False
+            while True:
+                while not exhausted and len(pending) < controller.limit:
+                    batch = next(batches, None)
+                    if batch is None:
+                        exhausted = True
+                    else:
+                        pending.add(executor.submit(process_batch, batch, enable_rdkit, compact_schema))
+                if not pending:
+                    break
+
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        seconds_per_atom, errors = future.result()
+                    except Exception as e:
+                        print(f"An error occurred: {e}")
+                        continue
+                    for error in errors:
+                        print(f"An error occurred: {error}")
+                    controller.update(seconds_per_atom, count_lock_waits(monitor_handler))
+                    connection_limit.value = controller.limit
+    finally:
+        monitor_handler.disconnect()
 
 
 def main():
@@ -60,6 +254,10 @@ def main():
     # IMPORT mode
     parser.add_argument("--import_pdb", action="store_true", help="Import PDB files into the database")
     parser.add_argument("--pdb_folder", type=str, help="Path to the folder containing PDB files")
+
+    # Create missing coordinate blobs and residue points for complexes imported by older versions
+    parser.add_argument("--build_coordinate_blobs", action="store_true", help="Create missing coordinate blobs of imported complexes")
+    parser.add_argument("--build_residue_points", action="store_true", help="Create missing residue points of imported complexes")
     
     # Enable rdkit ( smarts search ) # TODO SMARTS search is not implemented yet
     parser.add_argument(
@@ -68,6 +266,31 @@ def main():
         help="Enable rdkit ( smarts search )",
     )
 
+    # Import scheduling
+    parser.add_argument("--max_workers", type=int, default=30, help="Maximum number of import processes (database connections)")
+    parser.add_argument("--files_per_batch", type=int, default=20, help="Number of files imported per transaction")
+
+    # Partition data_points by complex_data_id (only applied when the table is created)
+    parser.add_argument(
+        "--partitioning",
+        type=str,
+        default=None,
+        choices=["hash", "range"],
+        help="Create data_points partitioned by complex_data_id (hash or range)",
+    )
+    parser.add_argument("--num_partitions", type=int, default=16, help="Number of data_points partitions")
+    parser.add_argument(
+        "--partition_range_size", type=int, default=100_000, help="Number of complex_data_ids per partition for range partitioning"
+    )
+
+    # Store type, origin and group_name as codes of lookup tables (only applied when the tables are created,
+    # the schema of an existing database is detected)
+    parser.add_argument(
+        "--compact_schema",
+        action="store_true",
+        help="Create data_points with dictionary encoded type, origin and group_name columns (new databases only)",
+    )
+
     # Add database type argument
     parser.add_argument(
         "--dbtype",
@@ -109,15 +332,24 @@ def main():
 
     try:
         # Initialize the database
-        init_db(db_handler, args.enable_rdkit)
+        compact_schema = init_db(
+            db_handler, args.enable_rdkit, args.partitioning, args.num_partitions, args.partition_range_size, args.compact_schema
+        )
 
         # IMPORT mode
         if args.import_pdb:
             if not args.pdb_folder:
                 parser.error("--pdb_folder is required when using --import_pdb")
             # Import PDB files from the specified folder
-            import_pdb_files(args.pdb_folder, db_params, args.dbtype, args.enable_rdkit)
+            import_pdb_files(
+                args.pdb_folder, db_params, args.dbtype, args.enable_rdkit, compact_schema, args.max_workers, args.files_per_batch
+            )
+
+        if args.build_coordinate_blobs:
+            build_coordinate_blobs(db_handler)
 
+        if args.build_residue_points:
+            build_residue_points(db_handler)
 
     finally:
         db_handler.disconnect()
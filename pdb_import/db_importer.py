@@ -1,8 +1,17 @@
 from Bio import PDB
 import warnings
 import io
-from typing import Dict, Any, List
+import math
+from typing import Dict, Any, List, Optional
 from database.handlers import DatabaseHandler, PostgresHandler
+from database.coordinate_blobs import encode_coordinate_blob
+from database.init_db import NAME_LOOKUP_TABLES
+
+# Cache of the codes of the compact schema lookup tables, per (column, name)
+_name_codes: Dict[tuple, int] = {}
+
+# Backbone atoms, excluded from the side chain centroid of residue_points
+BACKBONE_ATOM_TYPES = {"N", "CA", "C", "O", "OXT"}
 
 
 class InvalidPDBError(Exception):
@@ -18,6 +27,7 @@ def convert_to_native_types(data_points: List[Dict[str, Any]]) -> List[Dict[str,
             "type": str(point["type"]),
             "origin": str(point["origin"]),
             "group_name": str(point["group_name"]),
+            "residue_index": int(point["residue_index"]),
             "x": float(point["x"]),
             "y": float(point["y"]),
             "z": float(point["z"])
@@ -26,12 +36,26 @@ def convert_to_native_types(data_points: List[Dict[str, Any]]) -> List[Dict[str,
     return converted_points
 
 
-def import_pdb_to_db(pdb_content: str, pdb_identifier: str, db_handler: DatabaseHandler, enable_rdkit: bool) -> None:
-    # Parse PDB content and extract interaction points
-    data_points: List[Dict[str, Any]] = parse_pdb(pdb_content)
-    
-    # Convert numpy types to native Python types
-    data_points = convert_to_native_types(data_points)
+def import_pdb_to_db(
+    pdb_content: str,
+    pdb_identifier: str,
+    db_handler: DatabaseHandler,
+    enable_rdkit: bool,
+    compact_schema: bool = False,
+    commit: bool = True,
+    data_points: Optional[List[Dict[str, Any]]] = None,
+) -> None:
+    """Import a PDB file, with commit=False the caller commits (e.g. to import multiple files in one transaction)
+
+    With commit=False and the compact schema, the caller has to commit the names first (see commit_name_codes).
+    data_points can be passed if the file was already parsed with parse_data_points.
+    """
+    if data_points is None:
+        data_points = parse_data_points(pdb_content)
+
+    if compact_schema and commit:
+        # Resolve the lookup codes first and commit new names, so concurrent imports are not blocked
+        commit_name_codes(db_handler, data_points)
 
     conn = db_handler.get_connection()
     with conn.cursor() as cur:
@@ -65,6 +89,27 @@ def import_pdb_to_db(pdb_content: str, pdb_identifier: str, db_handler: Database
                         )
 
             for point in data_points:
+                if compact_schema:
+                    # Insert dictionary encoded data_points
+                    cur.execute(
+                        """
+                    INSERT INTO data_points_encoded
+                    (complex_data_id, element, type_code, origin_code, group_code, x, y, z)
+                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                    """,
+                        (
+                            complex_data_id,
+                            point["element"],
+                            _name_codes[("type", point["type"])],
+                            _name_codes[("origin", point["origin"])],
+                            _name_codes[("group_name", point["group_name"])],
+                            point["x"],
+                            point["y"],
+                            point["z"],
+                        ),
+                    )
+                    continue
+
                 # Insert data_points
                 cur.execute(
                     """
@@ -83,10 +128,194 @@ def import_pdb_to_db(pdb_content: str, pdb_identifier: str, db_handler: Database
                         point["z"],
                     ),
                 )
-            conn.commit()
+
+            # data_points ids are assigned in insertion order
+            cur.execute("SELECT id FROM data_points WHERE complex_data_id = %s ORDER BY id", (complex_data_id,))
+            ids = [row[0] for row in cur.fetchall()]
+
+            # Store all data_points of the complex additionally as one blob for fast loading
+            insert_coordinate_blob(cur, complex_data_id, ids, data_points)
+
+            # Store one pseudo atom per residue for the coarse residue level search
+            insert_residue_points(cur, complex_data_id, ids, data_points)
+
+            if commit:
+                conn.commit()
             print(f"Imported {pdb_identifier} to database")
 
 
+def parse_data_points(pdb_content: str) -> List[Dict[str, Any]]:
+    # Parse PDB content and extract interaction points
+    data_points: List[Dict[str, Any]] = parse_pdb(pdb_content)
+
+    # Convert numpy types to native Python types
+    return convert_to_native_types(data_points)
+
+
+def commit_name_codes(db_handler: DatabaseHandler, data_points: List[Dict[str, Any]]) -> None:
+    """Resolve the lookup codes of the data points in a transaction of their own, committing new names"""
+    conn = db_handler.get_connection()
+    try:
+        with conn.cursor() as cur:
+            resolve_name_codes(cur, db_handler, data_points)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        clear_name_code_cache()
+        raise
+
+
+def clear_name_code_cache() -> None:
+    """Clear the cached lookup codes, required after a rollback as they may refer to uncommitted names"""
+    _name_codes.clear()
+
+
+def resolve_name_codes(cur, db_handler: DatabaseHandler, data_points: List[Dict[str, Any]]) -> None:
+    """Load (or create) the lookup table codes of all names used by the data points into _name_codes"""
+    for column, lookup_table in NAME_LOOKUP_TABLES.items():
+        # Sorted to avoid deadlocks between concurrent imports inserting the same new names
+        for name in sorted({point[column] for point in data_points}):
+            if (column, name) in _name_codes:
+                continue
+
+            cur.execute(f"SELECT code FROM {lookup_table} WHERE name = %s", (name,))
+            row = cur.fetchone()
+            if row is not None:
+                code = row[0]
+            elif isinstance(db_handler, PostgresHandler):
+                # Each statement sees the names committed by concurrent imports (READ COMMITTED)
+                cur.execute(f"INSERT INTO {lookup_table} (name) VALUES (%s) ON CONFLICT (name) DO NOTHING", (name,))
+                cur.execute(f"SELECT code FROM {lookup_table} WHERE name = %s", (name,))
+                row = cur.fetchone()
+                if row is None:
+                    raise Exception(f"Failed to insert {name} into {lookup_table}")
+                code = row[0]
+            else:
+                # REPEATABLE READ would not show a name committed concurrently to a second SELECT (and INSERT IGNORE
+                # raises on the duplicate warning), so get the code of the existing row via LAST_INSERT_ID
+                cur.execute(
+                    f"INSERT INTO {lookup_table} (name) VALUES (%s) ON DUPLICATE KEY UPDATE code = LAST_INSERT_ID(code)",
+                    (name,),
+                )
+                code = cur.lastrowid
+                if not code:
+                    raise Exception(f"Failed to insert {name} into {lookup_table}")
+
+            _name_codes[(column, name)] = code
+
+
+def insert_coordinate_blob(cur, complex_data_id: int, ids: List[int], data_points: List[Dict[str, Any]]) -> None:
+    cur.execute(
+        "INSERT INTO complex_coordinates (complex_data_id, num_atoms, data) VALUES (%s, %s, %s)",
+        (complex_data_id, len(ids), encode_coordinate_blob(ids, data_points)),
+    )
+
+
+def insert_residue_points(cur, complex_data_id: int, ids: List[int], data_points: List[Dict[str, Any]]) -> None:
+    residues: Dict[int, List[tuple]] = {}
+    for atom_id, point in zip(ids, data_points):
+        residues.setdefault(point["residue_index"], []).append((atom_id, point))
+
+    for residue_atoms in residues.values():
+        # Centroid of the side chain (all atoms for residues without side chain, e.g. GLY or ligands)
+        side_chain = [point for _, point in residue_atoms if point["type"] not in BACKBONE_ATOM_TYPES]
+        centroid_atoms = side_chain or [point for _, point in residue_atoms]
+        x, y, z = (sum(point[c] for point in centroid_atoms) / len(centroid_atoms) for c in ["x", "y", "z"])
+
+        # All atoms of the residue lie within radius of the centroid
+        radius = max(math.dist((x, y, z), (point["x"], point["y"], point["z"])) for _, point in residue_atoms)
+
+        first_point = residue_atoms[0][1]
+        cur.execute(
+            """
+        INSERT INTO residue_points
+        (complex_data_id, origin, group_name, first_atom_id, last_atom_id, x, y, z, radius)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+        """,
+            (
+                complex_data_id,
+                first_point["origin"],
+                first_point["group_name"],
+                min(atom_id for atom_id, _ in residue_atoms),
+                max(atom_id for atom_id, _ in residue_atoms),
+                x,
+                y,
+                z,
+                radius,
+            ),
+        )
+
+
+def build_coordinate_blobs(db_handler: DatabaseHandler) -> None:
+    """Create the coordinate blobs for all complexes imported without one"""
+    conn = db_handler.get_connection()
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT complex_data_id FROM complex_data
+            WHERE complex_data_id NOT IN (SELECT complex_data_id FROM complex_coordinates)
+        """)
+        complex_data_ids = [row[0] for row in cur.fetchall()]
+
+        for complex_data_id in complex_data_ids:
+            cur.execute(
+                "SELECT id, element, type, origin, group_name, x, y, z FROM data_points WHERE complex_data_id = %s ORDER BY id",
+                (complex_data_id,),
+            )
+            rows = cur.fetchall()
+            if not rows:
+                continue
+            data_points = [
+                {"element": row[1], "type": row[2], "origin": row[3], "group_name": row[4], "x": row[5], "y": row[6], "z": row[7]}
+                for row in rows
+            ]
+            cur.execute(
+                "INSERT INTO complex_coordinates (complex_data_id, num_atoms, data) VALUES (%s, %s, %s)",
+                (complex_data_id, len(rows), encode_coordinate_blob([row[0] for row in rows], data_points)),
+            )
+            conn.commit()
+        print(f"Built coordinate blobs for {len(complex_data_ids)} complexes")
+
+
+def build_residue_points(db_handler: DatabaseHandler) -> None:
+    """Create the residue_points of all complexes imported without them.
+
+    Residue numbers are not stored in data_points, a new residue starts where the residue name or chain
+    changes or an atom name repeats (e.g. the N of the next amino acid or the O of the next water).
+    """
+    conn = db_handler.get_connection()
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT complex_data_id FROM complex_data
+            WHERE complex_data_id NOT IN (SELECT complex_data_id FROM residue_points)
+        """)
+        complex_data_ids = [row[0] for row in cur.fetchall()]
+
+        for complex_data_id in complex_data_ids:
+            cur.execute(
+                "SELECT id, type, origin, group_name, x, y, z FROM data_points WHERE complex_data_id = %s ORDER BY id",
+                (complex_data_id,),
+            )
+            rows = cur.fetchall()
+            if not rows:
+                continue
+
+            data_points = []
+            residue_index = 0
+            residue_types: set = set()
+            for i, row in enumerate(rows):
+                if i == 0 or row[2] != rows[i - 1][2] or row[3] != rows[i - 1][3] or row[1] in residue_types:
+                    residue_index += 1
+                    residue_types = set()
+                residue_types.add(row[1])
+                data_points.append(
+                    {"type": row[1], "origin": row[2], "group_name": row[3], "residue_index": residue_index, "x": row[4], "y": row[5], "z": row[6]}
+                )
+
+            insert_residue_points(cur, complex_data_id, [row[0] for row in rows], data_points)
+            conn.commit()
+        print(f"Built residue points for {len(complex_data_ids)} complexes")
+
+
 def parse_pdb(pdb_content):
     interaction_points = []
     parser = PDB.PDBParser(QUIET=True)  # type: ignore
@@ -97,9 +326,11 @@ def parse_pdb(pdb_content):
     except Exception as e:
         raise InvalidPDBError(f"Error parsing PDB file: {str(e)}")
 
+    residue_index = 0
     for model in structure:
         for chain in model:
             for residue in chain:
+                residue_index += 1
                 for atom in residue:
                     data_point = {
                         "pocket_key": None,  # Assign appropriate value
@@ -107,6 +338,7 @@ def parse_pdb(pdb_content):
                         "type": atom.name,
                         "origin": residue.resname,
                         "group_name": chain.id,
+                        "residue_index": residue_index,
                         "x": atom.coord[0],
                         "y": atom.coord[1],
                         "z": atom.coord[2],
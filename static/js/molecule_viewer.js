@@ -13,11 +13,21 @@ const elementColors = {
 
 let pickedAtoms = [];
 let distancePairs = [];
-let currentAtomData = [];
+let currentAtoms = null;  // Typed array columns of the loaded molecule, decoded by molecule_worker.js
+let lodComponents = null;
+let loadRequestId = 0;
 let isInitialLoad = true;
 let isAddingPairInNGL = false;
 let tempPairAtoms = [];
 
+// Molecules with more atoms are shown with CA atoms only until the camera is closer than LOD_FULL_ATOM_DISTANCE
+const LOD_MIN_ATOMS = 5000;
+const LOD_FULL_ATOM_DISTANCE = 80;  // Angstrom
+const ATOM_RADIUS = 0.5;  // CA atoms of the coarse level are drawn twice as large
+
+// Fetching and decoding the atoms is done in a worker, so large molecules do not block the page
+const moleculeWorker = new Worker(new URL('molecule_worker.js', document.currentScript.src));
+
 function getElementColor(atomicNumber) {
     return elementColors[atomicNumber] || elementColors['default'];
 }
@@ -29,73 +39,127 @@ function getElementSymbol(atomicNumber) {
     return symbols[atomicNumber] || `Element${atomicNumber}`;
 }
 
+function getAtom(index) {
+    // Coordinates are float32, round to the coordinate precision of PDB files
+    const round = value => Math.round(value * 1000) / 1000;
+    return {
+        id: currentAtoms.id[index],
+        element: currentAtoms.element[index],
+        type: currentAtoms.type[index],
+        origin: currentAtoms.origin[index],
+        x: round(currentAtoms.x[index]),
+        y: round(currentAtoms.y[index]),
+        z: round(currentAtoms.z[index])
+    };
+}
+
 function loadMolecule(pdb_id) {
     console.log('Loading molecule:', pdb_id);
     // Clear existing components and picks
     stage.removeAllComponents();
+    lodComponents = null;
     pickedAtoms = [];
-    currentAtomData = [];
+    currentAtoms = null;
     updateAtomList();
     distancePairs = [];
     updatePairList();
 
-    fetch(`/get_molecule/${pdb_id}`)
-        .then(response => {
-            if (!response.ok) {
-                throw new Error(`HTTP error! status: ${response.status}`);
-            }
-            return response.json();
-        })
-        .then(atomData => {
-            console.log('Atom data received:', atomData.slice(0, 5));
-            if (!atomData || atomData.length === 0) {
-                throw new Error('Received empty atom data');
-            }
-            
-            currentAtomData = atomData;
-            
-            // Create a shape component for the atoms
-            const shape = new NGL.Shape('atom_points');
-            atomData.forEach((atom, index) => {
-                const color = getElementColor(atom.element);
-                shape.addSphere([atom.x, atom.y, atom.z], color, 0.5, `atom${index}`);
-            });
-            
-            // Add the shape component to the stage
-            const shapeComp = stage.addComponentFromObject(shape);
-            shapeComp.addRepresentation('point');
-            
-            // Only set the view once when the molecule is initially loaded
-            if (isInitialLoad) {
-                stage.autoView();
-                isInitialLoad = false;
-            }
-            
-            console.log('Molecule loaded successfully');
-
-            // Add picking functionality
-            stage.mouseControls.add("clickPick-left", function(stage, pickingProxy) {
-                if (pickingProxy && pickingProxy.object && pickingProxy.object.name) {
-                    const atomIndex = parseInt(pickingProxy.object.name.slice(4));  // Extract index from "atomX" name
-                    if (!isNaN(atomIndex) && atomIndex < atomData.length) {
-                        const atom = atomData[atomIndex];
-                        if (isAddingPairInNGL) {
-                            handlePairSelection(atom, atomIndex);
-                        } else {
-                            toggleAtomSelection(atom, atomIndex);
-                        }
-                    }
-                }
-            });
+    loadRequestId++;
+    moleculeWorker.postMessage({ requestId: loadRequestId, pdbId: pdb_id, elementColors, radius: ATOM_RADIUS });
+}
 
-            // Load state from URL if available
-            loadStateFromURL();
-        })
-        .catch(error => {
-            console.error('Error loading molecule:', error);
-        });
+moleculeWorker.onmessage = function(event) {
+    const { requestId, atoms, full, coarse, error } = event.data;
+    if (requestId !== loadRequestId) {
+        return;  // Another molecule was selected in the meantime
+    }
+    if (error) {
+        console.error('Error loading molecule:', error);
+        return;
+    }
+    console.log(`Atom data received: ${atoms.id.length} atoms`);
+    currentAtoms = atoms;
+
+    // Large molecules start with the CA atoms only, all atoms are shown when zooming in
+    const useLod = atoms.id.length > LOD_MIN_ATOMS && coarse !== null;
+    lodComponents = {
+        full: addSphereComponent('atom_points', full),
+        coarse: useLod ? addSphereComponent('atom_points_ca', coarse) : null,
+        showFull: !useLod
+    };
+    lodComponents.full.setVisibility(!useLod);
+
+    // Only set the view once when the molecule is initially loaded
+    if (isInitialLoad) {
+        stage.autoView();
+        isInitialLoad = false;
+    }
+    updateLevelOfDetail();
+
+    console.log('Molecule loaded successfully');
+
+    // Load state from URL if available
+    loadStateFromURL();
+};
+
+function createAtomPicker(indices) {
+    // Maps the instance index of a picked sphere (pid) to the index of its atom in currentAtoms
+    return {
+        type: 'atom-sphere',
+        array: indices,
+        data: {},
+        getIndex: pid => indices[pid],
+        getObject: pid => ({ atomIndex: indices[pid] }),
+        getPosition: pid => new NGL.Vector3(currentAtoms.x[indices[pid]], currentAtoms.y[indices[pid]], currentAtoms.z[indices[pid]]),
+        _applyTransformations: vector => vector
+    };
+}
+
+function addSphereComponent(name, data) {
+    // One sphere buffer built directly from the typed arrays of the worker
+    const buffer = new NGL.SphereBuffer({
+        position: data.position,
+        color: data.color,
+        radius: data.radius,
+        picking: createAtomPicker(data.indices)
+    });
+    const shape = new NGL.Shape(name);
+    shape.addBuffer(buffer);
+    const component = stage.addComponentFromObject(shape);
+    component.addRepresentation('buffer');
+    return component;
 }
 
+function updateLevelOfDetail() {
+    if (!lodComponents || !lodComponents.coarse) {
+        return;
+    }
+    const cameraDistance = stage.viewer.cameraDistance ?? stage.viewer.camera.position.length();
+    const showFull = cameraDistance < LOD_FULL_ATOM_DISTANCE;
+    if (showFull !== lodComponents.showFull) {
+        lodComponents.showFull = showFull;
+        lodComponents.full.setVisibility(showFull);
+        lodComponents.coarse.setVisibility(!showFull);
+    }
+}
+
+stage.viewerControls.signals.changed.add(updateLevelOfDetail);
+
+// Add picking functionality
+stage.mouseControls.add("clickPick-left", function(stage, pickingProxy) {
+    if (pickingProxy && pickingProxy.picker && pickingProxy.picker.type === 'atom-sphere' && currentAtoms) {
+        const atomIndex = pickingProxy.picker.getIndex(pickingProxy.pid);
+        if (atomIndex < currentAtoms.id.length) {
+            const atom = getAtom(atomIndex);
+            if (isAddingPairInNGL) {
+                handlePairSelection(atom, atomIndex);
+            } else {
+                toggleAtomSelection(atom, atomIndex);
+            }
+        }
+    }
+});
+
 function updateAtomList() {
     const atomListBody = document.querySelector('#atomList tbody');
     const atom1Select = document.getElementById('atom1Select');
@@ -288,6 +352,10 @@ document.getElementById('searchButton').addEventListener('click', function() {
         },
         distance: pair.distance
     }));
+    const searchOptions = {
+        tolerance: parseFloat(document.getElementById('toleranceInput').value),
+        search_mode: document.getElementById('searchModeSelect').value
+    };
 
     // Open a new tab with the search results template
     const newTab = window.open(`/search_results`, '_blank');
@@ -300,7 +368,8 @@ document.getElementById('searchButton').addEventListener('click', function() {
             headers: {'Content-Type': 'application/json'},
             body: JSON.stringify({
                 selected_pairs: searchData,
-                skip_execution: true
+                skip_execution: true,
+                ...searchOptions
             })
         })
         .then(response => {
@@ -314,7 +383,7 @@ document.getElementById('searchButton').addEventListener('click', function() {
                 throw new Error(data.error);
             } else if (data.sql_query) {
                 // Initialize the search results in the new tab
-                newTab.initializeSearchResults(data.sql_query, searchData);
+                newTab.initializeSearchResults(data.sql_query, searchData, searchOptions);
             } else {
                 throw new Error('Unexpected response from server');
             }
@@ -330,25 +399,22 @@ document.getElementById('searchButton').addEventListener('click', function() {
 window.addEventListener('load', loadStateFromURL);
 
 function updateAtomHighlights() {
-    let shapeComp = stage.getComponentsByName('atom_points')[0];
-    const shape = new NGL.Shape('atom_points');
-    
-    currentAtomData.forEach((atom, index) => {
-        const color = getElementColor(atom.element);
-        const isSelected = pickedAtoms.some(a => a.index === index);
-        const radius = isSelected ? 0.75 : 0.5;  // Increase size for selected atoms
-        const adjustedColor = isSelected ? color.map(c => Math.min(c * 1.2, 1)) : color;  // Make selected atoms brighter
-        shape.addSphere([atom.x, atom.y, atom.z], adjustedColor, radius, `atom${index}`);
-    });
+    // Picked atoms are drawn as larger, brighter spheres on top of the molecule
+    let highlightComp = stage.getComponentsByName('picked-atoms')[0];
+    if (highlightComp) {
+        stage.removeComponent(highlightComp);
+    }
 
-    if (shapeComp) {
-        shapeComp.setShape(shape);
-        shapeComp.removeAllRepresentations();
-    } else {
-        shapeComp = stage.addComponentFromObject(shape);
+    if (pickedAtoms.length > 0) {
+        const shape = new NGL.Shape('picked-atoms');
+        pickedAtoms.forEach(atom => {
+            const color = getElementColor(atom.element).map(c => Math.min(c * 1.2, 1));
+            shape.addSphere([atom.x, atom.y, atom.z], color, 0.75);
+        });
+        highlightComp = stage.addComponentFromObject(shape);
+        // Clicks go through to the molecule, so picked atoms can be unselected
+        highlightComp.addRepresentation('buffer', { disablePicking: true });
     }
-    
-    shapeComp.addRepresentation('point');
     stage.viewer.requestRender();
 }
 
@@ -436,38 +502,9 @@ function deletePair(index) {
 }
 
 function updateNGLViewer() {
-    // Remove all existing components
-    stage.removeAllComponents();
-
-    // Recreate the atom points
-    const shape = new NGL.Shape('atom_points');
-    currentAtomData.forEach((atom, index) => {
-        const isSelected = pickedAtoms.some(a => a.index === index);
-        const color = getElementColor(atom.element);
-        const radius = isSelected ? 0.75 : 0.5;
-        const adjustedColor = isSelected ? color.map(c => Math.min(c * 1.2, 1)) : color;
-        shape.addSphere([atom.x, atom.y, atom.z], adjustedColor, radius, `atom${index}`);
-    });
-
-    const shapeComp = stage.addComponentFromObject(shape);
-    shapeComp.addRepresentation('point');
-
-    // Recreate the distance pairs
-    if (distancePairs.length > 0) {
-        const pairShape = new NGL.Shape('distance-pairs');
-        distancePairs.forEach((pair, index) => {
-            pairShape.addCylinder(
-                [pair.atom1.x, pair.atom1.y, pair.atom1.z],
-                [pair.atom2.x, pair.atom2.y, pair.atom2.z],
-                [1, 1, 0],  // yellow color
-                0.1  // radius
-            );
-        });
-        const pairComp = stage.addComponentFromObject(pairShape);
-        pairComp.addRepresentation('buffer');
-    }
-
-    stage.viewer.requestRender();
+    // The molecule component is kept, only the picked atoms and distance pairs are redrawn
+    updateAtomHighlights();
+    drawDistancePairs();
 }
 
 function toggleAtomSelection(atom, index) {
@@ -0,0 +1,131 @@
+// Web worker loading and decoding the atoms of a molecule off the main thread.
+// Receives {requestId, pdbId, elementColors, radius} and posts back the atoms as typed arrays together with
+// the sphere buffer data (position, color, radius) of all atoms and of the CA atoms only.
+// All typed arrays are transferred, not copied.
+
+// Must match the layout written by database/coordinate_blobs.py
+const BLOB_MAGIC = 'CMCB';
+const BLOB_VERSION = 1;
+const BLOB_HEADER_SIZE = 13;
+
+function decodeCoordinateBlob(buffer) {
+    const view = new DataView(buffer);
+    const magic = String.fromCharCode(...new Uint8Array(buffer, 0, 4));
+    const version = view.getUint8(4);
+    if (magic !== BLOB_MAGIC || version !== BLOB_VERSION) {
+        throw new Error(`Unsupported coordinate blob (magic ${magic}, version ${version})`);
+    }
+    const numAtoms = view.getUint32(5, true);
+    const numNames = view.getUint32(9, true);
+
+    let offset = BLOB_HEADER_SIZE;
+    // Columns are not aligned to their item size, slicing copies them into aligned buffers
+    const column = (ArrayType) => {
+        const end = offset + ArrayType.BYTES_PER_ELEMENT * numAtoms;
+        const values = new ArrayType(buffer.slice(offset, end));
+        offset = end;
+        return values;
+    };
+    const id = column(Int32Array);
+    const x = column(Float32Array);
+    const y = column(Float32Array);
+    const z = column(Float32Array);
+    const element = column(Uint8Array);
+    const typeCodes = column(Uint16Array);
+    const originCodes = column(Uint16Array);
+    const groupCodes = column(Uint16Array);
+    const names = numNames ? new TextDecoder().decode(new Uint8Array(buffer, offset)).split('\0') : [];
+
+    return {
+        id, element, x, y, z,
+        type: Array.from(typeCodes, code => names[code]),
+        origin: Array.from(originCodes, code => names[code]),
+        groupName: Array.from(groupCodes, code => names[code])
+    };
+}
+
+async function fetchCoordinateBlob(pdbId) {
+    if (typeof DecompressionStream === 'undefined') {
+        return null;
+    }
+    const response = await fetch(`/get_molecule_blob/${encodeURIComponent(pdbId)}`);
+    if (!response.ok) {
+        return null;  // No blob for this complex, use the JSON endpoint
+    }
+    // The blob is zlib compressed, which is the 'deflate' format of DecompressionStream
+    const stream = response.body.pipeThrough(new DecompressionStream('deflate'));
+    return decodeCoordinateBlob(await new Response(stream).arrayBuffer());
+}
+
+async function fetchAtomJson(pdbId) {
+    const response = await fetch(`/get_molecule/${encodeURIComponent(pdbId)}`);
+    if (!response.ok) {
+        throw new Error(`HTTP error! status: ${response.status}`);
+    }
+    const atomData = await response.json();
+    const numAtoms = atomData.length;
+    const atoms = {
+        id: new Int32Array(numAtoms),
+        element: new Uint8Array(numAtoms),
+        x: new Float32Array(numAtoms),
+        y: new Float32Array(numAtoms),
+        z: new Float32Array(numAtoms),
+        type: new Array(numAtoms),
+        origin: new Array(numAtoms),
+        groupName: null
+    };
+    atomData.forEach((atom, i) => {
+        atoms.id[i] = atom.id;
+        atoms.element[i] = atom.element;
+        atoms.x[i] = atom.x;
+        atoms.y[i] = atom.y;
+        atoms.z[i] = atom.z;
+        atoms.type[i] = atom.type;
+        atoms.origin[i] = atom.origin;
+    });
+    return atoms;
+}
+
+function buildSphereData(atoms, indices, elementColors, radius) {
+    // Buffer instance k is the atom indices[k], which is used to map picked instances to atoms
+    const position = new Float32Array(indices.length * 3);
+    const color = new Float32Array(indices.length * 3);
+    indices.forEach((i, k) => {
+        position[k * 3] = atoms.x[i];
+        position[k * 3 + 1] = atoms.y[i];
+        position[k * 3 + 2] = atoms.z[i];
+        color.set(elementColors[atoms.element[i]] || elementColors['default'], k * 3);
+    });
+    return { indices, position, color, radius: new Float32Array(indices.length).fill(radius) };
+}
+
+function sphereDataBuffers(data) {
+    return data ? [data.indices.buffer, data.position.buffer, data.color.buffer, data.radius.buffer] : [];
+}
+
+self.onmessage = async (event) => {
+    const { requestId, pdbId, elementColors, radius } = event.data;
+    try {
+        const atoms = (await fetchCoordinateBlob(pdbId)) || (await fetchAtomJson(pdbId));
+        const numAtoms = atoms.id.length;
+        if (numAtoms === 0) {
+            throw new Error('Received empty atom data');
+        }
+
+        const allIndices = new Uint32Array(numAtoms);
+        allIndices.forEach((_, i) => { allIndices[i] = i; });
+        const caIndices = Uint32Array.from(atoms.type.flatMap((type, i) => type === 'CA' && atoms.element[i] === 6 ? [i] : []));
+
+        const full = buildSphereData(atoms, allIndices, elementColors, radius);
+        const coarse = caIndices.length ? buildSphereData(atoms, caIndices, elementColors, radius * 2) : null;
+        self.postMessage(
+            { requestId, pdbId, atoms, full, coarse },
+            [
+                atoms.id.buffer, atoms.element.buffer, atoms.x.buffer, atoms.y.buffer, atoms.z.buffer,
+                ...sphereDataBuffers(full), ...sphereDataBuffers(coarse)
+            ]
+        );
+    } catch (error) {
+        self.postMessage({ requestId, pdbId, error: error.message });
+    }
+};